@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# 历史数据回填引擎：有界并发 + 令牌桶限流 + 分批提交 + 断点续传
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+# 令牌桶限流器：平均每秒最多发放rate个令牌，允许capacity个令牌的突发
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # 获取一个令牌，没有令牌时阻塞等待
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# 生成从start到end（含）的日期字符串列表
+def date_range(start, end):
+    if isinstance(start, str):
+        start = datetime.datetime.strptime(start, '%Y-%m-%d')
+    if isinstance(end, str):
+        end = datetime.datetime.strptime(end, '%Y-%m-%d')
+    dates = []
+    current = start
+    while current <= end:
+        dates.append(current.strftime('%Y-%m-%d'))
+        current += datetime.timedelta(days=1)
+    return dates
+
+
+# 并发回填一组日期
+#   fetch(date)        -> 该日的汇率字典，失败返回None
+#   save_batch(rows)   -> 在一个事务中写入 [(date, rates), ...]
+#   checkpoint(date)   -> 记录已处理到的日期（该日期及之前的都已处理），可选
+#   progress(stats)    -> 每批完成后报告进度 {'total', 'done', 'saved', 'failed'}，可选
+# 日期按顺序分批处理，每批完成后提交并记录断点，中断后可以从断点继续
+def run_backfill(dates, fetch, save_batch, checkpoint=None,
+                 workers=4, rate=5.0, batch_size=20, progress=None):
+    bucket = TokenBucket(rate)
+
+    def limited_fetch(date):
+        bucket.acquire()
+        try:
+            return date, fetch(date)
+        except Exception as e:
+            logger.warning("回填获取数据失败 date=%s error=%s", date, e)
+            return date, None
+
+    saved = 0
+    failed = []
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for i in range(0, len(dates), batch_size):
+            batch = dates[i:i + batch_size]
+            rows = []
+            for date, rates in executor.map(limited_fetch, batch):
+                if rates:
+                    rows.append((date, rates))
+                else:
+                    failed.append(date)
+            if rows:
+                save_batch(rows)
+                saved += len(rows)
+            if checkpoint is not None:
+                checkpoint(batch[-1])
+            done = min(i + batch_size, len(dates))
+            logger.info("回填进度 done=%d total=%d saved=%d", done, len(dates), saved)
+            if progress is not None:
+                progress({'total': len(dates), 'done': done, 'saved': saved, 'failed': len(failed)})
+
+    elapsed = time.monotonic() - started
+    logger.info("回填完成 total=%d saved=%d failed=%d elapsed=%.1fs", len(dates), saved, len(failed), elapsed)
+    return {'total': len(dates), 'saved': saved, 'failed': failed}
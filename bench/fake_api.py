@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# 模拟 jsdelivr / pages.dev 汇率API的本地服务器，可配置延迟和失败率
+#
+# 支持的路径（与真实API一致）：
+#   /npm/@fawazahmed0/currency-api@{date}/v1/currencies/{currency}.json
+#   /{date}/v1/currencies/{currency}.json
+# 汇率由日期决定（固定种子的随机游走），同一天多次请求返回相同结果
+import argparse
+import datetime
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PATH_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2}|latest)/v1/currencies/(\w+)\.json$')
+
+# 1人民币可兑换的外币数量（基准值）
+BASE_RATES = {'usd': 0.1378, 'eur': 0.1265, 'jpy': 20.44, 'gbp': 0.1052, 'hkd': 1.0712}
+
+
+# 某日的汇率：在基准值上叠加按日期确定的小幅波动
+def rates_for(date):
+    day = datetime.date.fromisoformat(date).toordinal()
+    rates = {}
+    for i, (currency, base) in enumerate(BASE_RATES.items()):
+        drift = 0.03 * math.sin(day / (40 + 7 * i)) + random.Random(day * 31 + i).uniform(-0.005, 0.005)
+        rates[currency] = round(base * (1 + drift), 8)
+    return rates
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    latency = 0.0  # 平均延迟（秒）
+    jitter = 0.0  # 延迟的随机抖动幅度（秒）
+    failure_rate = 0.0  # 返回503的概率
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with FakeApiHandler.lock:
+            FakeApiHandler.requests += 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.failure_rate:
+            self.send_error(503)
+            return
+
+        match = PATH_PATTERN.search(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        date, currency = match.groups()
+        if date == 'latest':
+            date = datetime.date.today().isoformat()
+        if currency != 'cny':
+            self.send_error(404)
+            return
+
+        body = json.dumps({'date': date, 'cny': rates_for(date)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# 在后台线程启动模拟API，返回服务器对象（server.server_address[1] 为实际端口）
+def start(port=0, latency=0.0, jitter=0.0, failure_rate=0.0):
+    FakeApiHandler.latency = latency
+    FakeApiHandler.jitter = jitter
+    FakeApiHandler.failure_rate = failure_rate
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# 指向模拟API的URL模板（可作为 EXCHANGE_API_SOURCES 环境变量）
+def source_templates(server):
+    port = server.server_address[1]
+    return [
+        f'http://127.0.0.1:{port}/npm/@fawazahmed0/currency-api@{{date}}/v1/currencies/{{currency}}.json',
+        f'http://127.0.0.1:{port}/{{date}}/v1/currencies/{{currency}}.json'
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='模拟汇率API服务器')
+    parser.add_argument('--port', type=int, default=9188)
+    parser.add_argument('--latency', type=float, default=0.05, help='平均延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.02, help='延迟抖动（秒）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='返回503的概率')
+    args = parser.parse_args()
+
+    server = start(args.port, args.latency, args.jitter, args.failure_rate)
+    print(f"模拟API已启动: EXCHANGE_API_SOURCES={','.join(source_templates(server))}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
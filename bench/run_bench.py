@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# 性能基准测试：在本地模拟API和合成的多年历史数据库上测量
+#   - 读接口 /api/rates、/api/stats 的延迟（p50/p99）和吞吐
+#   - 空数据库回填的吞吐
+#   - 定时任务（完整性检查、实时更新、最终数据标记）的耗时
+#
+# 用法：python bench/run_bench.py --years 1,3,5 --latency 0.05 --failure-rate 0.01
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_api
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+# 汇总耗时样本（秒），items为每次调用处理的条目数（用于计算吞吐）
+def summarize(name, samples, items=1, unit='req'):
+    total = sum(samples)
+    return {
+        'name': name,
+        'runs': len(samples),
+        'p50_ms': percentile(samples, 0.5) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'throughput': len(samples) * items / total if total else float('inf'),
+        'unit': f'{unit}/s'
+    }
+
+
+# 调用func共runs次，返回每次的耗时
+def measure(func, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+# 切换服务器使用的数据库，并清空依赖旧数据的缓存
+def use_database(server, path, start_date):
+    server.db.close()
+    server.db.configure(path)
+    server.init_db()
+    server.HISTORY_START_DATE = start_date
+    server._rates_snapshot = None
+    server.render_rates.cache_clear()
+    server.render_stats.cache_clear()
+    server.get_rolling_stats().dirty = True
+
+
+# 写入从start_date到昨天的合成最终数据，并把回填断点和完整性水位设置为昨天（模拟健康的数据库）
+def seed_database(server, start_date):
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    day = datetime.date.fromisoformat(start_date)
+    rows = []
+    while day <= yesterday:
+        date = day.isoformat()
+        rows.append((date, {c: 1 / v for c, v in fake_api.rates_for(date).items() if c in server.db.CURRENCIES}))
+        day += datetime.timedelta(days=1)
+    for i in range(0, len(rows), 1000):
+        server.db.upsert_rates(rows[i:i + 1000], is_final=1)
+    server.db.set_meta('backfill_checkpoint', yesterday.isoformat())
+    server.db.set_meta('complete_through', yesterday.isoformat())
+    return len(rows)
+
+
+# 读接口基准
+def bench_reads(server, client, runs):
+    results = []
+    full = client.get('/api/rates')
+    etag = full.headers['ETag']
+    cases = [
+        ('GET /api/rates (json)', '/api/rates', {}),
+        ('GET /api/rates (gzip)', '/api/rates', {'Accept-Encoding': 'gzip'}),
+        ('GET /api/rates (304)', '/api/rates', {'If-None-Match': etag}),
+        ('GET /api/rates?format=bin', '/api/rates?format=bin', {}),
+        ('GET /api/rates?max_points=1000', '/api/rates?max_points=1000', {}),
+        ('GET /api/rates?resolution=month', '/api/rates?resolution=month', {}),
+        ('GET /api/stats?currency=usd', '/api/stats?currency=usd', {}),
+    ]
+    for name, url, headers in cases:
+        results.append(summarize(name, measure(lambda: client.get(url, headers=headers), runs)))
+    # 随机日期范围（不同参数，绕过响应缓存）
+    dates = server.get_historical_rates()['dates']
+
+    def random_range():
+        start = random.randrange(len(dates))
+        end = min(len(dates) - 1, start + random.randint(7, 90))
+        client.get(f'/api/rates?from={dates[start]}&to={dates[end]}&currency=usd')
+    results.append(summarize('GET /api/rates?from&to (uncached)', measure(random_range, runs)))
+    return results
+
+
+# 定时任务基准
+def bench_jobs(server, runs, gaps):
+    results = [summarize('check_and_fill (healthy)', measure(server.check_and_fill_historical_data, runs), unit='run')]
+
+    # 制造缺口后测量一次补全
+    dates = server.get_historical_rates()['dates'][:-1]
+    missing = random.sample(dates, min(gaps, len(dates)))
+    with server.db.write_transaction() as conn:
+        conn.executemany("DELETE FROM rate_points WHERE date = ?", [(d,) for d in missing])
+    server.db.set_meta('complete_through', min(missing))
+    samples = measure(server.check_and_fill_historical_data, 1)
+    results.append(summarize(f'check_and_fill ({len(missing)} gaps)', samples, items=len(missing), unit='day'))
+
+    results.append(summarize('update_today_rate', measure(server.update_today_rate, runs), unit='run'))
+    # 当天标记为最终数据后再次运行会直接跳过，每次运行前（不计时）把当天改回非最终数据
+    today = datetime.date.today().isoformat()
+    samples = []
+    for _ in range(runs):
+        with server.db.write_transaction() as conn:
+            conn.execute("UPDATE rate_points SET is_final = 0 WHERE date = ?", (today,))
+        samples.extend(measure(server.finalize_today_data, 1))
+    results.append(summarize('finalize_today_data', samples, unit='run'))
+    return results
+
+
+# 空数据库回填基准
+def bench_backfill(server, tmpdir, days):
+    start = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+    use_database(server, os.path.join(tmpdir, 'backfill.db'), start)
+    samples = measure(server.backfill_history, 1)
+    return [summarize(f'backfill ({days} days)', samples, items=days, unit='day')]
+
+
+def print_results(title, results, out):
+    print(f"\n## {title}", file=out)
+    print(f"{'case':<40}{'runs':>6}{'p50 ms':>10}{'p99 ms':>10}{'throughput':>18}", file=out)
+    for r in results:
+        print(f"{r['name']:<40}{r['runs']:>6}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{r['throughput']:>12.1f} {r['unit']}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='汇率服务性能基准测试')
+    parser.add_argument('--years', default='1,3,5', help='合成历史数据的年数，逗号分隔')
+    parser.add_argument('--runs', type=int, default=200, help='每个读接口用例的请求次数')
+    parser.add_argument('--job-runs', type=int, default=5, help='每个定时任务的执行次数')
+    parser.add_argument('--gaps', type=int, default=30, help='完整性检查用例中制造的缺失天数')
+    parser.add_argument('--backfill-days', type=int, default=365, help='回填用例的天数')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟API的平均延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.02, help='模拟API的延迟抖动（秒）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='模拟API返回503的概率')
+    parser.add_argument('--json', help='同时把结果写入该JSON文件')
+    args = parser.parse_args()
+    random.seed(42)
+
+    api = fake_api.start(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate)
+    tmpdir = tempfile.mkdtemp(prefix='exrate-bench-')
+    os.environ['DB_PATH'] = os.path.join(tmpdir, 'init.db')
+    os.environ['EXCHANGE_API_SOURCES'] = ','.join(fake_api.source_templates(api))
+    os.environ.setdefault('BACKFILL_RATE', '50')
+    # 只输出错误日志，避免日志输出影响测量结果
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    os.environ['LOG_PATH'] = ''
+    # 不使用上游磁盘缓存，回填和补全都真实请求模拟API
+    os.environ['UPSTREAM_CACHE_DIR'] = ''
+    import server
+    client = server.app.test_client()
+
+    print(f"模拟API: 延迟 {args.latency}s ± {args.jitter}s，失败率 {args.failure_rate}；临时目录 {tmpdir}")
+    report = {}
+    for years in [int(y) for y in args.years.split(',')]:
+        start = (datetime.date.today() - datetime.timedelta(days=365 * years)).isoformat()
+        use_database(server, os.path.join(tmpdir, f'{years}y.db'), start)
+        rows = seed_database(server, start)
+        results = bench_reads(server, client, args.runs) + bench_jobs(server, args.job_runs, args.gaps)
+        title = f'{years} 年历史（{rows} 天）'
+        print_results(title, results, sys.stdout)
+        report[title] = results
+
+    results = bench_backfill(server, tmpdir, args.backfill_days)
+    print_results('回填', results, sys.stdout)
+    report['回填'] = results
+    print(f"\n模拟API共收到 {fake_api.FakeApiHandler.requests} 次请求")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
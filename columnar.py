@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# 紧凑的列式二进制格式，客户端可直接用 Int32Array / Float64Array 读取，无需逐个元素解析JSON
+#
+# 布局（小端序）：
+#   magic     4字节  b'EXR1'
+#   rows      uint32 行数
+#   columns   uint16 数值列数
+#   names     每列: uint8 名称长度 + ASCII名称
+#   padding   补齐到8字节边界
+#   days      int32[rows]   日期，自1970-01-01起的天数
+#   padding   补齐到8字节边界
+#   values    float64[rows] × columns，缺失值为NaN
+import datetime
+import struct
+import sys
+from array import array
+
+MAGIC = b'EXR1'
+MIMETYPE = 'application/vnd.exrate.columnar'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _pad(buffer):
+    remainder = len(buffer) % 8
+    if remainder:
+        buffer.extend(b'\0' * (8 - remainder))
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+# 日期字符串转为自1970-01-01起的天数
+def day_number(date_str):
+    return datetime.date.fromisoformat(date_str).toordinal() - EPOCH_ORDINAL
+
+
+# 天数转回日期字符串
+def day_string(day):
+    return datetime.date.fromordinal(day + EPOCH_ORDINAL).isoformat()
+
+
+def _header(rows, names):
+    buffer = bytearray(MAGIC)
+    buffer += struct.pack('<IH', rows, len(names))
+    for name in names:
+        encoded = name.encode('ascii')
+        buffer += struct.pack('<B', len(encoded)) + encoded
+    _pad(buffer)
+    return buffer
+
+
+# 编码，columns 为有序的 [(列名, 数值列表), ...]，None 编码为NaN
+def encode(dates, columns):
+    buffer = _header(len(dates), [name for name, _ in columns])
+    buffer += _little_endian(array('i', (day_number(d) for d in dates)))
+    _pad(buffer)
+    nan = float('nan')
+    for _, values in columns:
+        buffer += _little_endian(array('d', (nan if v is None else v for v in values)))
+    return bytes(buffer)
+
+
+# 由已经是小端序的数据块直接拼接编码（如内存映射文件的切片），不逐个转换元素
+# days 为若干int32数据块，columns 为 [(列名, 若干float64数据块), ...]
+def encode_raw(rows, days, columns):
+    buffer = _header(rows, [name for name, _ in columns])
+    for part in days:
+        buffer += part
+    _pad(buffer)
+    for _, parts in columns:
+        for part in parts:
+            buffer += part
+    return bytes(buffer)
+
+
+# 解析头部，返回 (行数, 列名列表, 日期的偏移, 各列数值的偏移列表)
+def layout(data):
+    if data[:4] != MAGIC:
+        raise ValueError('不是有效的列式数据')
+    rows, count = struct.unpack_from('<IH', data, 4)
+    offset = 10
+    names = []
+    for _ in range(count):
+        length = data[offset]
+        names.append(bytes(data[offset + 1:offset + 1 + length]).decode('ascii'))
+        offset += 1 + length
+    offset += -offset % 8
+    days_offset = offset
+    offset += rows * 4
+    offset += -offset % 8
+    return rows, names, days_offset, [offset + i * rows * 8 for i in range(count)]
+
+
+# 解码，返回 (日期列表, {列名: 数值列表})，NaN 还原为None
+def decode(data):
+    rows, names, days_offset, offsets = layout(data)
+    days = array('i')
+    days.frombytes(data[days_offset:days_offset + rows * 4])
+    columns = {}
+    for name, offset in zip(names, offsets):
+        values = array('d')
+        values.frombytes(data[offset:offset + rows * 8])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        columns[name] = [None if v != v else v for v in values]
+    if sys.byteorder == 'big':
+        days.byteswap()
+    return [day_string(d) for d in days], columns
+
+
+# 编码为Arrow IPC流（需要安装pyarrow）
+def encode_arrow(dates, columns):
+    import pyarrow as pa
+    arrays = [pa.array([day_number(d) for d in dates], type=pa.int32()).cast(pa.date32())]
+    names = ['date']
+    for name, values in columns:
+        arrays.append(pa.array(values, type=pa.float64()))
+        names.append(name)
+    table = pa.Table.from_arrays(arrays, names=names)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# 把 /api/rates 的结果字典展开为列：{货币}_rates 原样保留，{货币}_ohlc 拆成 open/high/low/close 四列
+def rates_columns(data):
+    columns = []
+    for key, values in data.items():
+        if key.endswith('_rates'):
+            columns.append((key, values))
+        elif key.endswith('_ohlc'):
+            currency = key[:-len('_ohlc')]
+            for i, field in enumerate(('open', 'high', 'low', 'close')):
+                columns.append((f'{currency}_{field}', [b[i] if b else None for b in values]))
+    return columns
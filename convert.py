@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# 批量货币换算：最终数据按日期排序保存在内存中（numpy数组），日期用二分查找定位到不晚于该日的最近最终数据，
+# 交叉汇率 A->B = (A兑计价货币) / (B兑计价货币)，整批向量化计算
+import datetime
+import threading
+
+import numpy as np
+
+import db
+from stats import GrowableArray
+
+
+# 按日期排序的最终汇率索引，新的一天追加时增量更新，历史数据被改写时整体重建
+class RateIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.days = GrowableArray(np.int64)
+        self.currencies = []
+        self.rates = {}
+        self.sources = {}  # 货币 -> 各天的汇率实际所属的日期（天数），沿用前一天汇率时为前一天
+        self.version = 0
+        self.dirty = True
+        self.rebuilding = 0  # 正在进行的重建数
+
+    # 从数据库读取全部最终数据；缺失值沿用前一天的汇率
+    # 标记在读取前清除：读取开始后提交的写入由on_write重新标记
+    def rebuild(self):
+        with self.lock:
+            self.dirty = False
+            self.rebuilding += 1
+        try:
+            rows = db.load_rates_range(final_only=True)
+            currencies = list(db.CURRENCIES)
+            days = GrowableArray(np.int64)
+            days.extend(np.array([row[0] for row in rows], dtype='datetime64[D]').astype(np.int64))
+            rates = {}
+            sources = {}
+            for i, currency in enumerate(currencies):
+                values = np.array([np.nan if row[i + 1] is None else row[i + 1] for row in rows], dtype=np.float64)
+                # 与forward_fill相同，同时记录沿用的汇率来自哪一天
+                index = np.where(np.isnan(values), 0, np.arange(len(values)))
+                np.maximum.accumulate(index, out=index)
+                rates[currency] = GrowableArray()
+                rates[currency].extend(values[index])
+                sources[currency] = GrowableArray(np.int64)
+                sources[currency].extend(days.view()[index])
+        except Exception:
+            with self.lock:
+                self.dirty = True
+                self.rebuilding -= 1
+            raise
+        with self.lock:
+            self.days, self.currencies, self.rates, self.sources = days, currencies, rates, sources
+            self.version += 1
+            self.rebuilding -= 1
+
+    def refresh_if_needed(self):
+        if self.dirty or self.currencies != list(db.CURRENCIES):
+            self.rebuild()
+
+    # 汇率写入后调用（可注册为db的写入监听器）：最后一天之后的新日期增量追加，改写最后一天时替换，其他情况标记为需要重建
+    def on_write(self, rows, is_final):
+        # 重建期间的写入不能增量追加到即将被替换的数组上，等重建完成后再重建
+        if self.rebuilding:
+            self.dirty = True
+        if self.dirty:
+            return
+        last = self.last_date()
+        dates = sorted(date for date, _ in rows)
+        if not is_final:
+            if last and dates[0] <= last:
+                self.dirty = True
+            return
+        if last and dates[0] < last:
+            self.dirty = True
+            return
+        for date in dates:
+            row = db.load_rates_range(date, date, self.currencies, final_only=True)
+            if not row:
+                continue
+            day = np.datetime64(date, 'D').astype(np.int64)
+            with self.lock:
+                replace = self.days.size > 0 and self.days.view()[-1] == day
+                if replace:
+                    self.days.size -= 1
+                self.days.append(day)
+                for i, currency in enumerate(self.currencies):
+                    array, source = self.rates[currency], self.sources[currency]
+                    if replace:
+                        array.size -= 1
+                        source.size -= 1
+                    value, value_day = row[0][i + 1], day
+                    if value is None:
+                        previous = array.view()
+                        value = previous[-1] if len(previous) else np.nan
+                        value_day = source.view()[-1] if len(previous) else day
+                    array.append(value)
+                    source.append(value_day)
+                self.version += 1
+
+    def last_date(self):
+        with self.lock:
+            if not self.days.size:
+                return None
+            return str(self.days.view()[-1].astype('datetime64[D]'))
+
+    # 批量换算，参数为等长序列：金额、源货币、目标货币、日期（YYYY-MM-DD，空表示使用最新的最终数据）
+    # 返回 {'result', 'rate', 'rate_date'}（numpy数组，无法换算的行为NaN/NaT）和错误列表 [(行号, 原因), ...]
+    # rate_date为汇率实际所属的日期，交叉汇率的两个货币来自不同日期时取较早的一个
+    def convert(self, amounts, sources, targets, dates):
+        self.refresh_if_needed()
+        count = len(amounts)
+        if not (len(sources) == len(targets) == len(dates) == count):
+            raise ValueError('amount、from、to、date的数量不一致')
+        quote = db.QUOTE_CURRENCY
+        with self.lock:
+            days = self.days.view().copy()
+            # 每一列为一种货币兑计价货币的汇率，最后一列为计价货币本身（恒为1）
+            currencies = list(self.currencies) + [quote]
+            table = np.column_stack([self.rates[c].view() for c in self.currencies] + [np.ones(len(days))]) \
+                if len(days) else np.empty((0, len(currencies)))
+            # 计价货币没有所属日期，取查询到的那一天
+            source_table = np.column_stack([self.sources[c].view() for c in self.currencies] + [days]) \
+                if len(days) else np.empty((0, len(currencies)), dtype=np.int64)
+
+        errors = []
+        amount_values = _parse_floats(amounts, errors)
+        query_days = _parse_days(dates, days[-1] if len(days) else None, errors)
+        source_columns = _currency_columns(sources, currencies, errors, 'from')
+        target_columns = _currency_columns(targets, currencies, errors, 'to')
+
+        # 二分查找不晚于查询日期的最近最终数据
+        positions = np.searchsorted(days, query_days, side='right') - 1
+        valid = (positions >= 0) & (source_columns >= 0) & (target_columns >= 0) & ~np.isnan(amount_values)
+        rate = np.full(count, np.nan)
+        rate_date = np.full(count, np.datetime64('NaT'), dtype='datetime64[D]')
+        if valid.any():
+            rows = positions[valid]
+            rate[valid] = table[rows, source_columns[valid]] / table[rows, target_columns[valid]]
+            rate_date[valid] = np.minimum(source_table[rows, source_columns[valid]],
+                                          source_table[rows, target_columns[valid]]).astype('datetime64[D]')
+        result = amount_values * rate
+
+        reported = {index for index, _ in errors}
+        for index in np.flatnonzero(~valid | np.isnan(rate)):
+            if int(index) not in reported:
+                errors.append((int(index), '该日期之前没有可用的最终汇率'))
+        errors.sort()
+        return {'result': result, 'rate': rate, 'rate_date': rate_date}, errors
+
+
+# 解析金额，缺失、无法解析或不是有限数值的为NaN并记录错误
+def _parse_floats(values, errors):
+    try:
+        parsed = np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        parsed = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                parsed[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+    # None会被转换为NaN，"nan"、"inf"可以解析但不是有效金额
+    for i in np.flatnonzero(~np.isfinite(parsed)):
+        parsed[i] = np.nan
+        errors.append((int(i), f'金额无效: {values[i]}'))
+    return parsed
+
+
+# 解析日期为天数（1970-01-01起），只接受 YYYY-MM-DD 字符串；空值使用latest，无法解析的记录错误（值为int64最小值）
+# 批量中日期种类通常远少于行数，每种日期只解析一次
+def _parse_days(values, latest, errors):
+    invalid = np.iinfo(np.int64).min
+    missing = invalid if latest is None else latest
+    epoch = datetime.date(1970, 1, 1).toordinal()
+    cache = {'': missing}
+    parsed = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        if value is None:
+            value = ''
+        elif not isinstance(value, str):
+            parsed[i] = invalid
+            errors.append((i, f'日期格式应为 YYYY-MM-DD: {value}'))
+            continue
+        day = cache.get(value)
+        if day is None:
+            try:
+                day = datetime.datetime.strptime(value, '%Y-%m-%d').toordinal() - epoch
+            except ValueError:
+                day = invalid
+            cache[value] = day
+        parsed[i] = day
+        if day == invalid and value != '':
+            errors.append((i, f'日期格式应为 YYYY-MM-DD: {value}'))
+    return parsed
+
+
+# 把货币代码映射为汇率表的列号，未知货币为-1并记录错误
+def _currency_columns(values, currencies, errors, field):
+    # 先去重再转小写和查表，批量中货币种类很少
+    codes, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    lookup = {currency: i for i, currency in enumerate(currencies)}
+    mapped = np.array([lookup.get(code.lower(), -1) for code in codes], dtype=np.int64)
+    columns = mapped[inverse]
+    for i in np.flatnonzero(columns < 0):
+        errors.append((int(i), f'不支持的货币({field}): {values[i]}'))
+    return columns
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+# 数据访问层：每个线程复用一个SQLite连接，WAL模式，所有写入经过同一个写锁
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'exchange_rate.db'
+# 已启用的货币（从currencies注册表加载）及计价货币，汇率表示1单位货币可兑换多少计价货币
+CURRENCIES = ['usd', 'eur', 'jpy']
+QUOTE_CURRENCY = 'cny'
+SCHEMA_VERSION = 3
+
+_local = threading.local()
+_write_lock = threading.Lock()
+# 写入监听器，汇率发生变化并提交后调用 listener(changed_rows, is_final)
+_write_listeners = []
+# 本进程写入产生的汇率数据版本（meta表中的rates_version），用于区分其他进程的写入
+_local_versions = set()
+_local_versions_lock = threading.Lock()
+
+
+# 设置数据库路径、默认货币列表（首次建库时写入注册表）和计价货币
+def configure(db_path, currencies=None, quote=None):
+    global DB_PATH, CURRENCIES, QUOTE_CURRENCY
+    DB_PATH = db_path
+    if currencies is not None:
+        CURRENCIES = list(currencies)
+    if quote is not None:
+        QUOTE_CURRENCY = quote
+    db_dir = os.path.dirname(DB_PATH)
+    if db_dir:  # 只有当路径不是当前目录时才创建
+        os.makedirs(db_dir, exist_ok=True)
+
+
+# 获取当前线程的连接，首次使用时创建并设置pragma
+def connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != DB_PATH:
+        # isolation_level=None：读操作不开启事务，写事务由write_transaction显式控制
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")  # 读写互不阻塞
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL模式下可安全使用，减少fsync
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA cache_size=-8000")  # 约8MB页缓存
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _local.conn = conn
+        _local.path = DB_PATH
+    return conn
+
+
+# 关闭当前线程的连接
+def close():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+# 写事务：进程内所有写入串行执行，BEGIN IMMEDIATE 避免事务中途升级写锁失败
+@contextmanager
+def write_transaction():
+    with metrics.DB_WRITE_LATENCY.time(), _write_lock:
+        conn = connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with metrics.DB_COMMIT_LATENCY.time():
+            conn.execute("COMMIT")
+
+
+# 执行只读查询，返回所有行
+def query(sql, params=()):
+    with metrics.DB_QUERY_LATENCY.time(op='query'):
+        return connection().execute(sql, params).fetchall()
+
+
+# 执行只读查询，返回第一行
+def query_one(sql, params=()):
+    with metrics.DB_QUERY_LATENCY.time(op='query_one'):
+        return connection().execute(sql, params).fetchone()
+
+
+# 生成按货币透视的列：MAX(CASE WHEN base = ? THEN rate END), ...，货币代码作为参数绑定（按顺序放在SELECT的参数位置）
+def _pivot_columns(currencies, alias=''):
+    return ', '.join(f"MAX(CASE WHEN {alias}base = ? THEN {alias}rate END)" for _ in currencies)
+
+
+def _placeholders(values):
+    return ', '.join('?' for _ in values)
+
+
+# 创建表结构，并把旧的宽表（每个货币一列）迁移为长表
+def init_schema():
+    global CURRENCIES
+    with write_transaction() as conn:
+        # 汇率长表：每个货币对每天一行，主键(base, quote, date)支持按货币对做范围查询
+        conn.execute('''CREATE TABLE IF NOT EXISTS rate_points
+                        (date TEXT NOT NULL,
+                         base TEXT NOT NULL,
+                         quote TEXT NOT NULL,
+                         rate REAL NOT NULL,
+                         is_final INTEGER DEFAULT 0,
+                         seq INTEGER NOT NULL DEFAULT 0,
+                         PRIMARY KEY (base, quote, date)) WITHOUT ROWID''')
+        # 按日期读取所有货币时使用
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_points_date ON rate_points (quote, date)")
+        # 货币注册表
+        conn.execute('''CREATE TABLE IF NOT EXISTS currencies
+                        (code TEXT PRIMARY KEY,
+                         enabled INTEGER DEFAULT 1,
+                         sort_order INTEGER DEFAULT 0)''')
+        # 键值表，保存回填断点等运行状态
+        conn.execute('''CREATE TABLE IF NOT EXISTS meta
+                        (key TEXT PRIMARY KEY,
+                         value TEXT)''')
+        # 日内采样（只追加），每次获取当天汇率时写入一行，收盘时压缩为当日OHLC后按保留天数清理
+        conn.execute('''CREATE TABLE IF NOT EXISTS rate_ticks
+                        (date TEXT NOT NULL,
+                         fetched_at TEXT NOT NULL,
+                         base TEXT NOT NULL,
+                         quote TEXT NOT NULL,
+                         rate REAL NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_ticks_date ON rate_ticks (quote, date)")
+        # 每日OHLC：采样时增量更新，收盘时由当日采样重新计算
+        conn.execute('''CREATE TABLE IF NOT EXISTS rate_daily_ohlc
+                        (date TEXT NOT NULL,
+                         base TEXT NOT NULL,
+                         quote TEXT NOT NULL,
+                         open REAL NOT NULL,
+                         high REAL NOT NULL,
+                         low REAL NOT NULL,
+                         close REAL NOT NULL,
+                         samples INTEGER NOT NULL,
+                         PRIMARY KEY (base, quote, date)) WITHOUT ROWID''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_daily_ohlc_date ON rate_daily_ohlc (quote, date)")
+        # 租约表，多进程部署时选出运行定时任务的进程
+        conn.execute('''CREATE TABLE IF NOT EXISTS leases
+                        (name TEXT PRIMARY KEY,
+                         owner TEXT NOT NULL,
+                         expires_at REAL NOT NULL)''')
+
+        for order, code in enumerate(CURRENCIES):
+            conn.execute("INSERT OR IGNORE INTO currencies (code, sort_order) VALUES (?, ?)", (code, order))
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            _migrate_wide_table(conn)
+            _add_change_seq(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        # 增量同步时按变化序号查找变化的行
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_points_seq ON rate_points (seq)")
+
+    CURRENCIES = list_currencies()
+
+
+# 迁移旧版 rates 表（date, usd_rate, eur_rate, jpy_rate, is_final）到 rate_points
+def _migrate_wide_table(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rates'").fetchone()
+    if not exists:
+        return
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(rates)")]
+    for column in columns:
+        if not column.endswith('_rate'):
+            continue
+        code = column[:-len('_rate')]
+        conn.execute("INSERT OR IGNORE INTO currencies (code, sort_order) "
+                     "VALUES (?, (SELECT COUNT(*) FROM currencies))", (code,))
+        conn.execute(f"""INSERT OR REPLACE INTO rate_points (date, base, quote, rate, is_final)
+                         SELECT date, ?, ?, {column}, COALESCE(is_final, 0)
+                         FROM rates WHERE {column} IS NOT NULL""", (code, QUOTE_CURRENCY))
+    conn.execute("DROP TABLE rates")
+    logger.info("已将旧版rates表迁移到rate_points")
+
+
+# 为旧版 rate_points 增加变化序号列，已有的行序号为0
+def _add_change_seq(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(rate_points)")]
+    if 'seq' not in columns:
+        conn.execute("ALTER TABLE rate_points ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        logger.info("已为rate_points增加变化序号列")
+
+
+# 已启用的货币，按注册顺序
+def list_currencies():
+    return [row[0] for row in query("SELECT code FROM currencies WHERE enabled = 1 ORDER BY sort_order, code")]
+
+
+# 注册（或重新启用）一个货币
+def register_currency(code):
+    global CURRENCIES
+    with write_transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO currencies (code, sort_order) "
+                     "VALUES (?, (SELECT COUNT(*) FROM currencies))", (code,))
+        conn.execute("UPDATE currencies SET enabled = 1 WHERE code = ?", (code,))
+    CURRENCIES = list_currencies()
+
+
+# 注册写入监听器
+def add_write_listener(listener):
+    _write_listeners.append(listener)
+
+
+# 读取一组日期的已有数据 {(date, base): (rate, is_final)}
+def _existing_points(conn, dates):
+    existing = {}
+    dates = list(dates)
+    for i in range(0, len(dates), 500):
+        chunk = dates[i:i + 500]
+        for date, base, rate, final in conn.execute(
+                f"SELECT date, base, rate, is_final FROM rate_points WHERE quote = ? AND date IN ({_placeholders(chunk)})",
+                [QUOTE_CURRENCY] + chunk):
+            existing[(date, base)] = (rate, final)
+    return existing
+
+
+# 已有最终数据的点 {(date, 货币), ...}
+def load_final_keys(dates):
+    keys = set()
+    dates = list(dates)
+    for i in range(0, len(dates), 500):
+        chunk = dates[i:i + 500]
+        keys.update(query(f"SELECT date, base FROM rate_points WHERE quote = ? AND is_final = 1 "
+                          f"AND date IN ({_placeholders(chunk)})", [QUOTE_CURRENCY] + chunk))
+    return keys
+
+
+# 批量写入汇率，rows为 [(date, {货币: 汇率}), ...]，在一个事务中用executemany提交
+# 值为None的货币不写入，保留原有数据；与已有数据相同的点跳过
+# 返回实际发生变化的行 [(date, {货币: 汇率}), ...]
+def upsert_rates(rows, is_final=0):
+    seq = None
+    with write_transaction() as conn:
+        existing = _existing_points(conn, {date for date, _ in rows})
+        params = []
+        changed = {}
+        for date, rates in rows:
+            for currency, rate in rates.items():
+                if rate is None or existing.get((date, currency)) == (rate, is_final):
+                    continue
+                params.append((date, currency, QUOTE_CURRENCY, rate, is_final))
+                changed.setdefault(date, {})[currency] = rate
+        if params:
+            # 汇率数据版本，同时作为本次写入的变化序号：其他进程据此发现数据变化，客户端据此做增量同步
+            conn.execute("INSERT INTO meta (key, value) VALUES ('rates_version', 1) "
+                         "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+            seq = int(conn.execute("SELECT value FROM meta WHERE key = 'rates_version'").fetchone()[0])
+            conn.executemany("INSERT OR REPLACE INTO rate_points (date, base, quote, rate, is_final, seq) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", [point + (seq,) for point in params])
+
+    # 提交成功后才记录（回滚的版本号可能被其他进程使用）
+    if seq is not None:
+        with _local_versions_lock:
+            _local_versions.add(seq)
+    changed_rows = sorted(changed.items())
+    if changed_rows:
+        for listener in _write_listeners:
+            try:
+                listener(changed_rows, is_final)
+            except Exception:
+                logger.exception("写入监听器执行失败 listener=%s", getattr(listener, '__name__', listener))
+    return changed_rows
+
+
+# 追加一次日内采样 {货币: 汇率}，并在同一事务中增量更新当日OHLC
+def append_ticks(date, rates, fetched_at):
+    params = [(date, fetched_at, currency, QUOTE_CURRENCY, rate) for currency, rate in rates.items() if rate is not None]
+    with write_transaction() as conn:
+        conn.executemany("INSERT INTO rate_ticks (date, fetched_at, base, quote, rate) VALUES (?, ?, ?, ?, ?)", params)
+        conn.executemany("""INSERT INTO rate_daily_ohlc (date, base, quote, open, high, low, close, samples)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+                            ON CONFLICT (base, quote, date) DO UPDATE SET
+                                high = MAX(high, excluded.high),
+                                low = MIN(low, excluded.low),
+                                close = excluded.close,
+                                samples = samples + 1""",
+                         [(date, currency, QUOTE_CURRENCY, rate, rate, rate, rate) for _, _, currency, _, rate in params])
+
+
+# 由某日的全部采样重新计算当日OHLC（开盘/收盘按采样时间取首尾），返回涉及的货币数
+def compact_ticks(date):
+    with write_transaction() as conn:
+        ticks = conn.execute("SELECT base, rate FROM rate_ticks WHERE quote = ? AND date = ? "
+                             "ORDER BY base, fetched_at, rowid", (QUOTE_CURRENCY, date)).fetchall()
+        bars = {}
+        for base, rate in ticks:
+            bar = bars.get(base)
+            if bar is None:
+                bars[base] = [rate, rate, rate, rate, 1]
+            else:
+                bar[1] = max(bar[1], rate)
+                bar[2] = min(bar[2], rate)
+                bar[3] = rate
+                bar[4] += 1
+        conn.executemany("INSERT OR REPLACE INTO rate_daily_ohlc (date, base, quote, open, high, low, close, samples) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(date, base, QUOTE_CURRENCY, *bar) for base, bar in bars.items()])
+    return len(bars)
+
+
+# 删除早于before（不含）的日内采样，返回删除的行数；对应日期的OHLC保留
+def prune_ticks(before):
+    with write_transaction() as conn:
+        return conn.execute("DELETE FROM rate_ticks WHERE quote = ? AND date < ?", (QUOTE_CURRENCY, before)).rowcount
+
+
+# 按日期范围读取每日OHLC，返回 [(date, base, open, high, low, close, samples), ...]，走(quote, date)索引
+def load_daily_ohlc(start=None, end=None, currencies=None):
+    currencies = currencies or CURRENCIES
+    return query(f"""SELECT date, base, open, high, low, close, samples FROM rate_daily_ohlc
+                     WHERE quote = ? AND date >= ? AND date <= ? AND base IN ({_placeholders(currencies)})
+                     ORDER BY date""",
+                 [QUOTE_CURRENCY, start or '0000-00-00', end or '9999-99-99'] + list(currencies))
+
+
+# 获取某日的最终数据，所有货币都有值时返回 {货币: 汇率}，否则返回None
+def get_final_rates(date, currencies=None):
+    currencies = currencies or CURRENCIES
+    rows = query(f"SELECT base, rate FROM rate_points WHERE date = ? AND quote = ? AND is_final = 1 "
+                 f"AND base IN ({_placeholders(currencies)})", [date, QUOTE_CURRENCY] + list(currencies))
+    rates = dict(rows)
+    if len(rates) == len(currencies):
+        return {currency: rates[currency] for currency in currencies}
+    return None
+
+
+# 按日期范围读取汇率并按货币透视为宽行，利用(quote, date)索引做范围扫描
+# 返回 [(date, 各货币汇率...), ...]，start/end 为None时不限制，final_only时只返回最终数据
+def load_rates_range(start=None, end=None, currencies=None, final_only=False):
+    currencies = currencies or CURRENCIES
+    final_filter = "AND is_final = 1" if final_only else ""
+    return query(f"""SELECT date, {_pivot_columns(currencies)} FROM rate_points
+                     WHERE quote = ? AND date >= ? AND date <= ? AND base IN ({_placeholders(currencies)})
+                     {final_filter}
+                     GROUP BY date ORDER BY date""",
+                 list(currencies) + [QUOTE_CURRENCY, start or '0000-00-00', end or '9999-99-99'] + list(currencies))
+
+
+# 读取全部最终数据 [(base, date, rate), ...]，按货币、日期排序
+def load_final_points():
+    return query("SELECT base, date, rate FROM rate_points WHERE quote = ? AND is_final = 1 ORDER BY base, date",
+                 (QUOTE_CURRENCY,))
+
+
+# 按日期顺序逐批读取汇率点 (date, base, quote, rate, is_final)，用于导出；整个导出在同一个读快照中完成，
+# 内存占用与总行数无关
+def iter_rate_points(start=None, end=None, currencies=None, final_only=False, batch_size=5000):
+    currencies = currencies or CURRENCIES
+    final_filter = "AND is_final = 1" if final_only else ""
+    cursor = connection().execute(f"""SELECT date, base, quote, rate, is_final FROM rate_points
+                                      WHERE quote = ? AND date >= ? AND date <= ? AND base IN ({_placeholders(currencies)})
+                                      {final_filter}
+                                      ORDER BY date, base""",
+                                  [QUOTE_CURRENCY, start or '0000-00-00', end or '9999-99-99'] + list(currencies))
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+
+# 用递归CTE在数据库内找出[start, end]范围内缺失或有货币为空的日期
+# 返回 {日期: {货币: 已有汇率或None}}
+def find_missing_dates(start, end):
+    sql = f"""WITH RECURSIVE days(d) AS (
+                  SELECT ? UNION ALL SELECT date(d, '+1 day') FROM days WHERE d < ?
+              )
+              SELECT days.d, {_pivot_columns(CURRENCIES, 'p.')}
+              FROM days LEFT JOIN rate_points p
+                ON p.date = days.d AND p.quote = ? AND p.base IN ({_placeholders(CURRENCIES)})
+              GROUP BY days.d HAVING COUNT(p.base) < ?
+              ORDER BY days.d"""
+    rows = query(sql, [start, end] + CURRENCIES + [QUOTE_CURRENCY] + CURRENCIES + [len(CURRENCIES)])
+    return {row[0]: dict(zip(CURRENCIES, row[1:])) for row in rows}
+
+
+# 当前的变化序号（每次有变化的写入加1）
+def current_seq():
+    return int(get_meta('rates_version', 0))
+
+
+# 取出本进程写入产生的、不大于upto的版本（之后的版本留到下次）
+def pop_local_versions(upto):
+    with _local_versions_lock:
+        versions = {version for version in _local_versions if version <= upto}
+        _local_versions.difference_update(versions)
+    return versions
+
+
+# 读取变化序号大于since的日期的完整数据（日期内任一货币变化即返回该日所有货币），start/end 为None时不限制日期
+# 返回 [(date, is_final, 各货币汇率...), ...]，日期范围在子查询中过滤，仍走seq索引，开销与变化的行数成正比
+def load_changes_since(since, currencies=None, start=None, end=None):
+    currencies = currencies or CURRENCIES
+    return query(f"""SELECT date, MIN(is_final), {_pivot_columns(currencies)} FROM rate_points
+                     WHERE quote = ? AND base IN ({_placeholders(currencies)})
+                       AND date IN (SELECT date FROM rate_points WHERE seq > ? AND date >= ? AND date <= ?)
+                     GROUP BY date ORDER BY date""",
+                 list(currencies) + [QUOTE_CURRENCY] + list(currencies)
+                 + [since, start or '0000-00-00', end or '9999-99-99'])
+
+
+# 最后一个最终数据的日期，没有时返回None
+def last_final_date():
+    return query_one("SELECT MAX(date) FROM rate_points WHERE quote = ? AND is_final = 1", (QUOTE_CURRENCY,))[0]
+
+
+# 已有数据的日期范围 (最早日期, 最晚日期, 天数)
+def date_bounds():
+    return query_one("SELECT MIN(date), MAX(date), COUNT(DISTINCT date) FROM rate_points WHERE quote = ?",
+                     (QUOTE_CURRENCY,))
+
+
+# 读取运行状态
+def get_meta(key, default=None):
+    row = query_one("SELECT value FROM meta WHERE key = ?", (key,))
+    return row[0] if row else default
+
+
+# 保存运行状态
+def set_meta(key, value):
+    with write_transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+# 获取或续约租约：租约不存在、已过期或本来就属于owner时成功，返回是否持有租约
+# BEGIN IMMEDIATE 保证多个进程同时争抢时只有一个能写入
+def acquire_lease(name, owner, ttl):
+    now = time.time()
+    with write_transaction() as conn:
+        row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        if row and row[0] != owner and row[1] > now:
+            return False
+        conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                     (name, owner, now + ttl))
+        return True
+
+
+# 释放租约（只释放自己持有的）
+def release_lease(name, owner):
+    with write_transaction() as conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
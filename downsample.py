@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# 时间序列降采样：LTTB（保留形状的点抽取）和按周/按月的OHLC聚合
+import datetime
+
+
+# Largest-Triangle-Three-Buckets 降采样，返回被保留的点的下标（有序）
+# xs、ys 长度相同且不含None；threshold 为最多保留的点数
+def lttb(xs, ys, threshold):
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # 下一个桶的平均点
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        count = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / count
+        avg_y = sum(ys[avg_start:avg_end]) / count
+
+        # 当前桶中与前一个选中点、下一个桶平均点构成最大三角形的点
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        max_area = -1
+        next_a = range_start
+        for j in range(range_start, range_end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        selected.append(next_a)
+        a = next_a
+    selected.append(n - 1)
+    return selected
+
+
+# 多条共用x轴的序列一起降采样：每条序列做LTTB后取选中点的并集，返回保留的下标（有序），数量尽量接近且不超过max_points
+# series中的序列可以含None（跳过）；每条序列保留的点数用二分查找确定，并集不足max_points时再从多保留一个点的结果中均匀补足
+def lttb_union(xs, series, max_points):
+    valid = [[i for i, v in enumerate(ys) if v is not None] for ys in series]
+
+    def union(threshold):
+        keep = set()
+        for ys, points in zip(series, valid):
+            chosen = lttb([xs[i] for i in points], [ys[i] for i in points], threshold)
+            keep.update(points[i] for i in chosen)
+        return keep
+
+    # 每条序列保留 max_points // 序列数 个点时并集一定不超过max_points，从这里开始向上查找
+    best = None
+    lo, hi = max(3, max_points // max(len(series), 1)), max(3, max_points)
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        keep = union(mid)
+        if len(keep) <= max_points:
+            best, lo = (mid, keep), mid + 1
+        else:
+            hi = mid - 1
+    if best is None:
+        # 每条序列最少3个点，序列较多时并集仍超过max_points，均匀抽取
+        return _spread(sorted(union(3)), max_points)
+    threshold, keep = best
+    if len(keep) < max_points:
+        extra = sorted(union(threshold + 1) - keep)
+        keep.update(_spread(extra, max_points - len(keep)))
+    return sorted(keep)
+
+
+# 从有序列表中均匀取出count个元素
+def _spread(values, count):
+    if count >= len(values):
+        return list(values)
+    return [values[i * len(values) // count] for i in range(count)]
+
+
+# 计算日期所在周期的起始日期（week: 周一，month: 当月1日）
+def period_start(date_str, resolution):
+    date = datetime.date.fromisoformat(date_str)
+    if resolution == 'week':
+        date -= datetime.timedelta(days=date.weekday())
+    elif resolution == 'month':
+        date = date.replace(day=1)
+    return date.isoformat()
+
+
+# 按周期聚合为OHLC，返回 (周期起始日期列表, [[open, high, low, close], ...])
+# 值为None的点被跳过，整个周期都没有值时该周期的OHLC为None
+def ohlc(dates, values, resolution):
+    periods = []
+    buckets = []
+    for date, value in zip(dates, values):
+        key = period_start(date, resolution)
+        if not periods or periods[-1] != key:
+            periods.append(key)
+            buckets.append(None)
+        if value is None:
+            continue
+        bucket = buckets[-1]
+        if bucket is None:
+            buckets[-1] = [value, value, value, value]
+        else:
+            bucket[1] = max(bucket[1], value)
+            bucket[2] = min(bucket[2], value)
+            bucket[3] = value
+    return periods, buckets
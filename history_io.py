@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# 汇率历史数据的批量导入/导出，用于初始化新环境或在主机之间迁移数据（不访问上游API）
+#
+# 文件为长格式，每行是一个货币对一天的汇率，列为 date, base, quote, rate, is_final：
+#   CSV：第一行为表头；JSONL：每行一个JSON对象，如 {"date": "2025-05-16", "base": "usd", "quote": "cny", "rate": 7.21, "is_final": 1}
+# 格式按扩展名判断（.csv / .jsonl，可再加 .gz 压缩），也可用 --format 指定；文件名为 - 时使用标准输入/输出
+#
+# 用法：
+#   python history_io.py export history.csv.gz [--from 2020-01-01] [--to 2024-12-31] [--currency usd,eur] [--final-only]
+#   python history_io.py import history.csv.gz [--batch-size 5000] [--final] [--register]
+#
+# 读取、校验、分批、写入串成生成器流水线，内存占用与文件大小无关；每批在一个事务中用executemany写入
+import argparse
+import csv
+import datetime
+import functools
+import gzip
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+import db
+from history_store import HistoryStore
+
+FIELDS = ('date', 'base', 'quote', 'rate', 'is_final')
+# 最多输出多少条无效行的详情
+MAX_REPORTED_ERRORS = 20
+
+
+# 根据参数或扩展名确定文件格式
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    if path == '-':
+        return 'csv'
+    name = path[:-len('.gz')] if path.endswith('.gz') else path
+    if name.endswith('.jsonl') or name.endswith('.ndjson'):
+        return 'jsonl'
+    if name.endswith('.csv'):
+        return 'csv'
+    raise ValueError(f"无法根据文件名判断格式，请使用 --format: {path}")
+
+
+def open_text(path, mode):
+    if path == '-':
+        stream = sys.stdin.buffer if mode == 'r' else sys.stdout.buffer
+        return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+# 逐行读取记录，产生 (行号, 字典)
+def read_records(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_num, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_num, record if isinstance(record, dict) else {'_error': 'JSON格式无效'}
+
+
+# 规范化为补零的日期格式，保证按字符串排序与按日期排序一致；同一日期在文件中出现多次（每个货币一行），解析结果缓存
+@functools.lru_cache(maxsize=4096)
+def normalize_date(text):
+    return datetime.datetime.strptime(text, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+# 命令行的日期参数，未指定时为None
+def date_option(text):
+    if not text:
+        return None
+    try:
+        return normalize_date(text)
+    except ValueError:
+        raise ValueError(f"日期格式应为 YYYY-MM-DD: {text}")
+
+
+def parse_final(value):
+    if value is None or value == '':
+        return 0
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes'):
+        return 1
+    if text in ('0', 'false', 'no'):
+        return 0
+    raise ValueError(f"is_final 无效: {value}")
+
+
+# 校验并规范化一条记录，返回 (date, base, rate, is_final)，无效时抛出ValueError
+# register时允许未注册的货币，在写入时注册（无效的行不会注册货币）
+def validate(record, force_final, register):
+    if '_error' in record:
+        raise ValueError(record['_error'])
+    date = str(record.get('date') or '').strip()
+    try:
+        date = normalize_date(date)
+    except ValueError:
+        raise ValueError(f"日期格式应为 YYYY-MM-DD: {date}")
+    base = str(record.get('base') or '').strip().lower()
+    if len(base) != 3 or not base.isalpha():
+        raise ValueError(f"货币代码无效: {base}")
+    if base not in db.CURRENCIES and not register:
+        raise ValueError(f"货币未注册（可使用 --register）: {base}")
+    quote = str(record.get('quote') or db.QUOTE_CURRENCY).strip().lower()
+    if quote != db.QUOTE_CURRENCY:
+        raise ValueError(f"计价货币应为 {db.QUOTE_CURRENCY}: {quote}")
+    try:
+        rate = float(record.get('rate'))
+    except (TypeError, ValueError):
+        raise ValueError(f"汇率无效: {record.get('rate')}")
+    if not math.isfinite(rate) or rate <= 0:
+        raise ValueError(f"汇率无效: {rate}")
+    is_final = 1 if force_final else parse_final(record.get('is_final'))
+    return date, base, rate, is_final
+
+
+# 过滤掉无效记录（输出到标准错误），产生有效的汇率点
+def valid_points(records, force_final, register, stats):
+    for line_num, record in records:
+        stats['read'] += 1
+        try:
+            yield validate(record, force_final, register)
+        except ValueError as e:
+            stats['invalid'] += 1
+            if stats['invalid'] <= MAX_REPORTED_ERRORS:
+                print(f"第{line_num}行: {e}", file=sys.stderr)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# 写入一批汇率点：按is_final分组，每组用 upsert_rates 在一个事务中写入（跳过未变化的点，并记录变化序号）
+# 未注册的货币（--register）在写入前注册；非最终数据不覆盖已有的最终数据；返回 (变化的点数, 因已有最终数据而跳过的点数)
+def write_batch(points):
+    groups = {}
+    for date, base, rate, is_final in points:
+        groups.setdefault(is_final, {}).setdefault(date, {})[base] = rate
+    for base in sorted({base for _, base, _, _ in points} - set(db.CURRENCIES)):
+        db.register_currency(base)
+    changed = kept = 0
+    for is_final, rows in sorted(groups.items()):
+        if not is_final:
+            final_keys = db.load_final_keys(rows)
+            for date, rates in rows.items():
+                for base in [base for base in rates if (date, base) in final_keys]:
+                    del rates[base]
+                    kept += 1
+        for _, rates in db.upsert_rates(sorted(rows.items()), is_final):
+            changed += len(rates)
+    return changed, kept
+
+
+# 按服务器相同的环境变量（DB_PATH、CURRENCIES、HISTORY_PATH）打开数据库，返回历史数据文件（未启用时为None）
+def open_database():
+    load_dotenv()
+    db_path = os.getenv('DB_PATH', 'exchange_rate.db')
+    db.configure(db_path, os.getenv('CURRENCIES', 'usd,eur,jpy').split(','), quote='cny')
+    db.init_schema()
+    history_path = os.getenv('HISTORY_PATH', '' if os.name == 'nt' else os.path.splitext(db_path)[0] + '.history')
+    return HistoryStore(history_path) if history_path else None
+
+
+def import_history(args, history_store):
+    fmt = detect_format(args.file, args.format)
+    stats = {'read': 0, 'invalid': 0, 'written': 0, 'kept_final': 0}
+    started = time.monotonic()
+    with open_text(args.file, 'r') as stream:
+        points = valid_points(read_records(stream, fmt), args.final, args.register, stats)
+        for batch in batched(points, args.batch_size):
+            changed, kept = write_batch(batch)
+            stats['written'] += changed
+            stats['kept_final'] += kept
+            print(f"已读取 {stats['read']} 行，写入 {stats['written']} 个变化的汇率", file=sys.stderr)
+    # 重新生成历史数据文件，运行中的服务进程会自动重新映射
+    if history_store is not None:
+        history_store.current(db.CURRENCIES)
+    elapsed = time.monotonic() - started
+    print(f"导入完成: 读取 {stats['read']} 行，无效 {stats['invalid']} 行，写入 {stats['written']} 个变化的汇率，"
+          f"跳过 {stats['kept_final']} 个已有最终数据的非最终汇率，耗时 {elapsed:.1f}s（{stats['read'] / elapsed if elapsed else 0:.0f} 行/秒）", file=sys.stderr)
+    return 1 if stats['invalid'] else 0
+
+
+def export_history(args):
+    fmt = detect_format(args.file, args.format)
+    # 在打开输出文件之前校验，参数错误时不会清空已有的文件
+    start, end = date_option(args.start), date_option(args.end)
+    if start and end and start > end:
+        raise ValueError(f"开始日期晚于结束日期: {start} > {end}")
+    currencies = db.CURRENCIES
+    if args.currency:
+        currencies = [c.strip().lower() for c in args.currency.split(',') if c.strip()]
+        unknown = [c for c in currencies if c not in db.CURRENCIES]
+        if unknown:
+            print(f"不支持的货币: {','.join(unknown)}", file=sys.stderr)
+            return 2
+    count = 0
+    started = time.monotonic()
+    with open_text(args.file, 'w') as stream:
+        points = db.iter_rate_points(start, end, currencies, final_only=args.final_only)
+        if fmt == 'csv':
+            writer = csv.writer(stream, lineterminator='\n')
+            writer.writerow(FIELDS)
+            for point in points:
+                writer.writerow(point)
+                count += 1
+        else:
+            for point in points:
+                stream.write(json.dumps(dict(zip(FIELDS, point)), separators=(',', ':')) + '\n')
+                count += 1
+    print(f"导出完成: {count} 行，耗时 {time.monotonic() - started:.1f}s", file=sys.stderr)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='汇率历史数据的批量导入/导出（CSV/JSONL）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='导出汇率历史')
+    export_parser.add_argument('file', help='输出文件（.csv/.jsonl，可加 .gz），- 表示标准输出')
+    export_parser.add_argument('--from', dest='start', help='开始日期（YYYY-MM-DD）')
+    export_parser.add_argument('--to', dest='end', help='结束日期（YYYY-MM-DD）')
+    export_parser.add_argument('--currency', help='货币列表，如 usd,eur，默认全部')
+    export_parser.add_argument('--final-only', action='store_true', help='只导出最终数据')
+    export_parser.add_argument('--format', choices=('csv', 'jsonl'), help='文件格式，默认按扩展名判断')
+
+    import_parser = subparsers.add_parser('import', help='导入汇率历史')
+    import_parser.add_argument('file', help='输入文件（.csv/.jsonl，可加 .gz），- 表示标准输入')
+    import_parser.add_argument('--batch-size', type=int, default=5000, help='每个事务写入的行数')
+    import_parser.add_argument('--final', action='store_true', help='把导入的数据都标记为最终数据（忽略 is_final 列）')
+    import_parser.add_argument('--register', action='store_true', help='自动注册文件中未注册的货币')
+    import_parser.add_argument('--format', choices=('csv', 'jsonl'), help='文件格式，默认按扩展名判断')
+    args = parser.parse_args()
+    if args.command == 'import' and args.batch_size < 1:
+        parser.error('--batch-size 必须大于0')
+
+    # 只输出警告和错误日志，进度和结果由本脚本输出到标准错误
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        history_store = open_database()
+        if args.command == 'export':
+            return export_history(args)
+        return import_history(args, history_store)
+    except (OSError, ValueError) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
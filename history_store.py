@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# 只读的历史数据文件：按日期排序的汇率以列式二进制格式（columnar.py 的EXR1布局：int32天数 + 每个货币一列float64）
+# 保存在磁盘上，各工作进程以只读方式内存映射同一个文件，按日期范围切片和序列化直接使用映射的视图，
+# 工作进程增加时数据只在操作系统的页缓存中保存一份
+#
+# 文件包含最后一个最终数据日期及之前的全部数据，之后的日期（当天的实时数据）从数据库读取；
+# 本进程写入最终数据或改写了文件覆盖的日期后，在下次读取时重新生成文件（写临时文件再原子替换），
+# 其他进程发现文件变化（inode、修改时间、大小）后重新映射
+import bisect
+import logging
+import mmap
+import os
+import sys
+import tempfile
+import threading
+from array import array
+
+import columnar
+import db
+
+logger = logging.getLogger(__name__)
+
+
+# 一次内存映射：日期和各货币的汇率都是映射内存上的视图（小端序，本机字节序相同时才能直接使用）
+class _Mapping:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        data = memoryview(self.mm)
+        rows, names, days_offset, offsets = columnar.layout(data)
+        self.rows = rows
+        self.days = data[days_offset:days_offset + rows * 4].cast('i')
+        self.columns = {name: data[offset:offset + rows * 8].cast('d') for name, offset in zip(names, offsets)}
+        self.last_day = self.days[-1] if rows else None
+
+    # 日期范围 [start, end] 对应的行号区间（二分查找）
+    def bounds(self, start, end):
+        lo = bisect.bisect_left(self.days, columnar.day_number(start)) if start else 0
+        hi = bisect.bisect_right(self.days, columnar.day_number(end)) if end else self.rows
+        return lo, max(lo, hi)
+
+
+class HistoryStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mapping = None
+        self.dirty = True
+
+    # 写入监听器：写入了最终数据或文件已覆盖的日期时，文件需要重新生成
+    def on_write(self, rows, is_final):
+        mapping = self.mapping
+        if is_final or mapping is None or mapping.last_day is None:
+            self.dirty = True
+        elif min(columnar.day_number(date) for date, _ in rows) <= mapping.last_day:
+            self.dirty = True
+
+    # 返回当前的映射：需要时重新生成文件，文件被其他进程替换后重新映射；不可用时返回None（调用方改为读数据库）
+    def current(self, currencies):
+        if sys.byteorder != 'little':
+            return None
+        mapping = self.mapping
+        if not self.dirty and mapping is not None and self._unchanged(mapping) \
+                and all(currency in mapping.columns for currency in currencies):
+            return mapping
+        with self.lock:
+            try:
+                if self.dirty or self.mapping is None or \
+                        not all(currency in self.mapping.columns for currency in currencies):
+                    self.regenerate()
+                elif not self._unchanged(self.mapping):
+                    self.mapping = _Mapping(self.path)
+            except (OSError, ValueError):
+                logger.exception("历史数据文件不可用 path=%s", self.path)
+                self.mapping = None
+                self.dirty = True
+            return self.mapping
+
+    def _unchanged(self, mapping):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return mapping.identity == (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    # 从数据库生成文件：写临时文件后原子替换，正在使用旧映射的读取不受影响
+    def regenerate(self):
+        # 先清除标记再读取数据库，读取期间的新写入会再次标记
+        self.dirty = False
+        currencies = list(db.CURRENCIES)
+        end = db.last_final_date()
+        rows = db.load_rates_range(end=end, currencies=currencies) if end else []
+        body = columnar.encode([row[0] for row in rows],
+                               [(currency, [row[i + 1] for row in rows]) for i, currency in enumerate(currencies)])
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.history-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+        self.mapping = _Mapping(self.path)
+        logger.info("历史数据文件已生成 path=%s rows=%d through=%s", self.path, len(rows), end)
+
+    # 日期范围内的数据库部分（文件最后一天之后的日期）
+    def _tail(self, mapping, start, end, currencies):
+        if mapping.last_day is not None:
+            after = columnar.day_string(mapping.last_day + 1)
+            start = max(start, after) if start else after
+        if end and start and start > end:
+            return []
+        return db.load_rates_range(start, end, currencies)
+
+    # 读取日期范围内的数据，返回 (日期列表, {货币: 汇率列表})，缺失值为None；文件不可用时返回None
+    def read(self, start, end, currencies):
+        mapping = self.current(currencies)
+        if mapping is None:
+            return None
+        lo, hi = mapping.bounds(start, end)
+        tail = self._tail(mapping, start, end, currencies)
+        dates = [columnar.day_string(day) for day in mapping.days[lo:hi]] + [row[0] for row in tail]
+        series = {}
+        for i, currency in enumerate(currencies):
+            values = [None if v != v else v for v in mapping.columns[currency][lo:hi].tolist()]
+            series[currency] = values + [row[i + 1] for row in tail]
+        return dates, series
+
+    # 把日期范围内的数据直接编码为列式二进制（列名为 {货币}_rates），文件部分直接复制映射内存；文件不可用时返回None
+    def encode(self, start, end, currencies):
+        mapping = self.current(currencies)
+        if mapping is None:
+            return None
+        lo, hi = mapping.bounds(start, end)
+        tail = self._tail(mapping, start, end, currencies)
+        days = [mapping.days[lo:hi], array('i', (columnar.day_number(row[0]) for row in tail))]
+        nan = float('nan')
+        columns = [(f'{currency}_rates',
+                    [mapping.columns[currency][lo:hi], array('d', (nan if row[i + 1] is None else row[i + 1]
+                                                                   for row in tail))])
+                   for i, currency in enumerate(currencies)]
+        return columnar.encode_raw(hi - lo + len(tail), days, columns)
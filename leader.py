@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# 调度租约选举：多个工作进程共用一个数据库时，只有持有租约的进程运行定时任务
+# 租约保存在SQLite的leases表中，持有者定期续约；持有者退出或卡住超过ttl秒后由其他进程接管
+import logging
+import os
+import socket
+import threading
+import uuid
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseElector:
+    def __init__(self, name, ttl=30.0, on_elected=None, on_demoted=None):
+        self.name = name
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.is_leader = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # 尝试获取或续约一次，租约状态变化时调用回调
+    def tick(self):
+        try:
+            acquired = db.acquire_lease(self.name, self.owner, self.ttl)
+        except Exception:
+            logger.exception("获取调度租约失败 lease=%s owner=%s", self.name, self.owner)
+            acquired = False
+        if acquired and not self.is_leader:
+            self.is_leader = True
+            logger.info("已获得调度租约 lease=%s owner=%s", self.name, self.owner)
+            if self.on_elected:
+                self.on_elected()
+        elif not acquired and self.is_leader:
+            self.is_leader = False
+            logger.warning("已失去调度租约 lease=%s owner=%s", self.name, self.owner)
+            if self.on_demoted:
+                self.on_demoted()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.tick()
+            # 在租约过期前多次续约，容忍偶尔的数据库繁忙
+            self.stopped.wait(self.ttl / 3)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'lease-{self.name}', daemon=True)
+        self.thread.start()
+
+    # 停止续约并主动释放租约，其他进程可以立即接管
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        if self.is_leader:
+            self.is_leader = False
+            if self.on_demoted:
+                self.on_demoted()
+            try:
+                db.release_lease(self.name, self.owner)
+            except Exception:
+                logger.exception("释放调度租约失败 lease=%s owner=%s", self.name, self.owner)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# 轻量的Prometheus指标：计数器和直方图，按标签分组，以文本格式导出
+# 多进程部署时各进程定期把自己的指标写入共享目录（每个进程一个文件），导出时合并所有进程的数据
+import atexit
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 默认的直方图分桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+_shared_dir = None
+
+
+def _label_text(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def collect(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_label_text(self.labelnames, key)} {value}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # 标签 -> [各分桶计数..., 总和, 总数]
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    # 计时上下文：with histogram.time(label=...): ...
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: list(state) for key, state in self.values.items()}
+
+    def collect(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f'{self.name}_bucket{_label_text(self.labelnames, key, ("le", repr(float(bound))))} {cumulative}'
+            yield f'{self.name}_bucket{_label_text(self.labelnames, key, ("le", "+Inf"))} {state[-1]}'
+            yield f'{self.name}_sum{_label_text(self.labelnames, key)} {state[-2]}'
+            yield f'{self.name}_count{_label_text(self.labelnames, key)} {state[-1]}'
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+# 装饰器：记录函数的执行耗时
+def timed(histogram, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# 启用多进程共享：本进程每interval秒把指标写入 directory/<pid>.json，退出时再写一次
+# 已退出的进程的文件保留（计数器不会因为工作进程重启而减少），目录应在服务启动前清空
+def share(directory, interval=5):
+    global _shared_dir
+    os.makedirs(directory, exist_ok=True)
+    _shared_dir = directory
+    threading.Thread(target=_flush_periodically, args=(interval,), name='metrics-flush', daemon=True).start()
+    atexit.register(flush)
+
+
+def _flush_periodically(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except Exception:
+            logger.exception("写入指标文件失败 dir=%s", _shared_dir)
+
+
+# 把本进程的指标写入共享目录（写临时文件后原子替换）
+def flush():
+    data = {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in _registry}
+    fd, tmp = tempfile.mkstemp(dir=_shared_dir, prefix='.metrics-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, os.path.join(_shared_dir, f'{os.getpid()}.json'))
+
+
+# 合并共享目录中其他进程的指标和本进程内存中的指标，返回 {指标名: {标签: 值}}
+def _merged():
+    merged = {metric.name: metric.snapshot() for metric in _registry}
+    own = f'{os.getpid()}.json'
+    for name in os.listdir(_shared_dir):
+        if not name.endswith('.json') or name == own:
+            continue
+        try:
+            with open(os.path.join(_shared_dir, name), encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.warning("读取指标文件失败 file=%s", name)
+            continue
+        for metric_name, items in data.items():
+            values = merged.get(metric_name)
+            if values is None:
+                continue
+            for key, value in items:
+                key = tuple(key)
+                current = values.get(key)
+                if current is None:
+                    values[key] = value
+                elif isinstance(current, list):
+                    if len(current) == len(value):
+                        values[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    values[key] = current + value
+    return merged
+
+
+# 以Prometheus文本格式导出所有指标（启用共享时为所有进程的合计）
+def render():
+    merged = _merged() if _shared_dir else {}
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.collect(merged.get(metric.name)))
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 各模块共用的指标
+UPSTREAM_LATENCY = Histogram('exrate_upstream_request_seconds', '上游API请求耗时', ('source', 'outcome'))
+DB_QUERY_LATENCY = Histogram('exrate_db_query_seconds', 'SQLite查询耗时', ('op',))
+DB_COMMIT_LATENCY = Histogram('exrate_db_commit_seconds', 'SQLite写事务提交耗时')
+DB_WRITE_LATENCY = Histogram('exrate_db_write_transaction_seconds', 'SQLite写事务总耗时（含等待写锁）')
+CACHE_REQUESTS = Counter('exrate_cache_requests_total', '缓存访问次数', ('cache', 'result'))
+JOB_DURATION = Histogram('exrate_job_duration_seconds', '定时任务耗时', ('job',),
+                         buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+HTTP_LATENCY = Histogram('exrate_http_request_seconds', 'HTTP请求处理耗时', ('endpoint', 'status'))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# 按日期查询汇率：每个货币的最终数据按日期排序保存在内存中（int32天数 + float64汇率），二分查找定位，
+# 查询时不访问数据库和上游API
+#   精确查询：该日期有最终数据时返回
+#   as-of查询：返回不晚于该日期的最近一个最终数据（周末、节假日或缺失的日期使用之前最近一天的汇率）
+import bisect
+import threading
+from array import array
+
+import db
+from columnar import day_number, day_string
+
+
+class AsOfIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}  # 货币 -> (天数数组, 汇率数组)
+        self.version = 0
+        self.dirty = True
+        self.rebuilding = 0  # 正在进行的重建数
+
+    # 从数据库读取全部最终数据；先清除标记再读取，读取期间的写入会再次标记
+    def rebuild(self):
+        with self.lock:
+            self.dirty = False
+            self.rebuilding += 1
+        try:
+            series = {}
+            for base, date, rate in db.load_final_points():
+                if base not in series:
+                    series[base] = (array('i'), array('d'))
+                days, rates = series[base]
+                days.append(day_number(date))
+                rates.append(rate)
+        except Exception:
+            with self.lock:
+                self.dirty = True
+                self.rebuilding -= 1
+            raise
+        with self.lock:
+            self.series = series
+            self.version += 1
+            self.rebuilding -= 1
+
+    def refresh_if_needed(self):
+        if self.dirty:
+            self.rebuild()
+
+    # 汇率写入后调用（注册为db的写入监听器）：某货币最后一天之后的最终数据追加，改写最后一天时替换，
+    # 其他情况（改写更早的日期、最终数据被改回非最终数据）标记为需要重建
+    def on_write(self, rows, is_final):
+        with self.lock:
+            # 重建中读取的结果可能不包含这次写入，增量更新又会作用在即将被替换的数据上
+            if self.rebuilding:
+                self.dirty = True
+            if self.dirty:
+                return
+            for date, rates in rows:
+                day = day_number(date)
+                for currency, rate in rates.items():
+                    days, values = self.series.get(currency) or (None, None)
+                    last = days[-1] if days else None
+                    if not is_final:
+                        if last is not None and day <= last:
+                            self.dirty = True
+                            return
+                        continue
+                    if days is None:
+                        self.series[currency] = (array('i', [day]), array('d', [rate]))
+                    elif last is None or day > last:
+                        days.append(day)
+                        values.append(rate)
+                    elif day == last:
+                        values[-1] = rate
+                    else:
+                        self.dirty = True
+                        return
+            self.version += 1
+
+    # 查询一个货币在某日的汇率，返回 (汇率, 汇率所属日期)，没有时返回None
+    # date为None时使用该货币最新的最终数据
+    def lookup(self, currency, date, asof=True):
+        self.refresh_if_needed()
+        with self.lock:
+            days, rates = self.series.get(currency) or (None, None)
+            if not days:
+                return None
+            if date is None:
+                return rates[-1], day_string(days[-1])
+            day = day_number(date)
+            i = bisect.bisect_right(days, day) - 1
+            if i < 0 or (not asof and days[i] != day):
+                return None
+            return rates[i], day_string(days[i])
@@ -2,13 +2,22 @@ import schedule
 import time
 import subprocess
 import os
+import shlex
 import signal
 import sys
 import logging
 import requests
 from datetime import datetime
-import psutil
 import atexit
+# Windows下用于查找已存在的进程；Linux下使用pidfile + flock，不需要psutil
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # 配置日志
 logging.basicConfig(
@@ -24,6 +33,25 @@ logging.basicConfig(
 LOCK_FILE = 'schedule_server.lock'
 server_process = None
 
+# Linux监管模式配置
+PID_FILE = os.getenv('SUPERVISOR_PID_FILE', 'schedule_server.pid')
+# 启动服务器的命令，默认 python server.py，也可以使用多进程模式，例如
+# SERVER_CMD="gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:9088 wsgi:app"
+SERVER_CMD = os.getenv('SERVER_CMD', f'{sys.executable} server.py')
+HEALTH_URL = os.getenv('HEALTH_URL', 'http://localhost:9088/api/rates')
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', 30))  # 健康检查间隔（秒）
+HEALTH_TIMEOUT = float(os.getenv('HEALTH_TIMEOUT', 5))
+HEALTH_MAX_FAILURES = int(os.getenv('HEALTH_MAX_FAILURES', 3))  # 连续失败多少次后重启
+HEALTH_GRACE = float(os.getenv('HEALTH_GRACE', 30))  # 启动后多久开始健康检查
+STOP_TIMEOUT = float(os.getenv('STOP_TIMEOUT', 10))  # 发送SIGTERM后等待退出的时间，超时后强制终止
+
+pid_file = None
+server_wanted = False  # 当前时段服务器是否应该运行
+server_started_at = 0.0
+health_failures = 0
+health_etag = None
+pending_signal = None
+
 def check_existing_process():
     """只检测其他 python.exe 的 schedule_server.py 或 server.py 进程"""
     current_pid = os.getpid()
@@ -82,7 +110,11 @@ def is_server_running_time():
     return 9 <= current_hour < 21
 
 def start_server():
-    global server_process
+    global server_process, server_wanted
+    server_wanted = True
+    if fcntl is not None:
+        start_server_posix()
+        return
     if server_process is None or server_process.poll() is not None:
         try:
             # 检查是否已有server.py在运行
@@ -119,7 +151,11 @@ def start_server():
         logging.warning('服务器已经在运行中')
 
 def stop_server():
-    global server_process
+    global server_process, server_wanted
+    server_wanted = False
+    if fcntl is not None:
+        stop_server_posix()
+        return
     if server_process is not None and server_process.poll() is None:
         try:
             # 在Windows下，发送CTRL_BREAK_EVENT信号来终止进程组
@@ -138,6 +174,164 @@ def stop_server():
     else:
         logging.warning('服务器未在运行')
 
+def acquire_pid_file():
+    """用flock锁定pidfile，保证只有一个监管进程；进程退出（包括崩溃）时锁自动释放，不需要扫描进程表"""
+    global pid_file
+    f = open(PID_FILE, 'a+')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.seek(0)
+        logging.error('已有监管进程在运行 (PID: %s)', f.read().strip() or '未知')
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    pid_file = f
+    return True
+
+def start_server_posix():
+    """启动服务器子进程（独立进程组，停止时连同其子进程一起终止）"""
+    global server_process, server_started_at, health_failures, health_etag
+    if server_process is not None and server_process.poll() is None:
+        logging.warning('服务器已经在运行中')
+        return
+    try:
+        server_process = subprocess.Popen(shlex.split(SERVER_CMD), start_new_session=True)
+        server_started_at = time.monotonic()
+        health_failures = 0
+        health_etag = None
+        logging.info('服务器已启动，进程ID: %s，命令: %s', server_process.pid, SERVER_CMD)
+    except Exception as e:
+        logging.error('启动服务器时出错: %s', e)
+
+def stop_server_posix():
+    """向服务器进程组发送SIGTERM，超时后SIGKILL"""
+    global server_process
+    if server_process is None or server_process.poll() is not None:
+        server_process = None
+        logging.warning('服务器未在运行')
+        return
+    try:
+        os.killpg(server_process.pid, signal.SIGTERM)
+        server_process.wait(timeout=STOP_TIMEOUT)
+        logging.info('服务器已停止')
+    except subprocess.TimeoutExpired:
+        os.killpg(server_process.pid, signal.SIGKILL)
+        server_process.wait()
+        logging.warning('服务器未在%s秒内退出，已强制终止', STOP_TIMEOUT)
+    except ProcessLookupError:
+        pass
+    server_process = None
+
+def restart_server():
+    stop_server_posix()
+    start_server_posix()
+
+def server_reloads_on_hup():
+    """SERVER_CMD是否为gunicorn：gunicorn主进程收到SIGHUP时启动新的工作进程后再平滑停止旧的"""
+    args = shlex.split(SERVER_CMD)
+    return bool(args) and ('gunicorn' in os.path.basename(args[0]) or args[1:3] == ['-m', 'gunicorn'])
+
+def reload_server():
+    """gunicorn只向主进程转发SIGHUP（工作进程收到SIGHUP会直接退出）；开发服务器没有重载机制，停止后重新启动"""
+    global server_started_at, health_failures
+    if server_process is None or server_process.poll() is not None or not server_reloads_on_hup():
+        restart_server()
+        return
+    try:
+        os.kill(server_process.pid, signal.SIGHUP)
+    except ProcessLookupError:
+        restart_server()
+        return
+    # 重载期间新的工作进程还在启动，重新计算健康检查的宽限期
+    server_started_at = time.monotonic()
+    health_failures = 0
+    logging.info('已通知服务器平滑重载，进程ID: %s', server_process.pid)
+
+def check_health():
+    """健康检查：进程意外退出时立即重启；/api/rates 连续多次失败时重启（带上次的ETag，正常时只返回304）"""
+    global health_failures, health_etag
+    if not server_wanted:
+        return
+    if server_process is None or server_process.poll() is not None:
+        code = server_process.returncode if server_process is not None else None
+        logging.error('服务器进程已退出 (退出码: %s)，重新启动', code)
+        start_server_posix()
+        return
+    if time.monotonic() - server_started_at < HEALTH_GRACE:
+        return
+    try:
+        headers = {'If-None-Match': health_etag} if health_etag else {}
+        response = requests.get(HEALTH_URL, headers=headers, timeout=HEALTH_TIMEOUT)
+        healthy = response.status_code in (200, 304)
+        if response.status_code == 200:
+            health_etag = response.headers.get('ETag')
+    except requests.RequestException as e:
+        logging.warning('健康检查失败: %s', e)
+        healthy = False
+    if healthy:
+        health_failures = 0
+        return
+    health_failures += 1
+    logging.warning('健康检查失败 (%d/%d)', health_failures, HEALTH_MAX_FAILURES)
+    if health_failures >= HEALTH_MAX_FAILURES:
+        logging.error('健康检查连续失败，重启服务器')
+        restart_server()
+
+def handle_signal(signum, frame):
+    """信号处理函数只记录信号，由主循环处理"""
+    global pending_signal
+    pending_signal = signum
+
+def supervise():
+    """Linux监管模式：pidfile + flock保证单实例，定时启停、健康检查，SIGTERM/SIGINT退出，SIGHUP重载服务器"""
+    global pending_signal
+    if not acquire_pid_file():
+        sys.exit(1)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, handle_signal)
+    setup_schedule()
+    logging.info('监管进程已启动 (PID: %s)', os.getpid())
+    if is_server_running_time():
+        start_server()
+    
+    last_check = time.monotonic()
+    try:
+        while True:
+            if pending_signal == signal.SIGHUP:
+                pending_signal = None
+                logging.info('收到SIGHUP，重载服务器')
+                if server_wanted:
+                    reload_server()
+            elif pending_signal is not None:
+                logging.info('收到终止信号 (%s)', signal.Signals(pending_signal).name)
+                break
+            schedule.run_pending()
+            if time.monotonic() - last_check >= HEALTH_INTERVAL:
+                last_check = time.monotonic()
+                check_health()
+            time.sleep(1)
+    finally:
+        stop_server_posix()
+        # 清空pidfile（不删除，避免新实例锁定另一个同名文件），锁随进程退出释放
+        pid_file.seek(0)
+        pid_file.truncate()
+
+def setup_schedule():
+    # 设置定时任务
+    schedule.every().day.at("09:00").do(start_server)
+    schedule.every().day.at("21:00").do(stop_server)
+    
+    # 只在工作日10:10更新汇率数据
+    schedule.every().monday.at("10:10").do(update_exchange_rate)
+    schedule.every().tuesday.at("10:10").do(update_exchange_rate)
+    schedule.every().wednesday.at("10:10").do(update_exchange_rate)
+    schedule.every().thursday.at("10:10").do(update_exchange_rate)
+    schedule.every().friday.at("10:10").do(update_exchange_rate)
+
 def update_exchange_rate():
     # 检查是否为工作日且在服务器运行时间内
     if is_workday() and is_server_running_time():
@@ -153,6 +347,11 @@ def update_exchange_rate():
         logging.info('当前不是工作日或不在服务器运行时间内，跳过更新')
 
 def main():
+    # Linux/Unix使用监管模式
+    if fcntl is not None:
+        supervise()
+        return
+    
     # 检查是否已有实例在运行
     if check_existing_process():
         logging.error('发现已存在的相关进程，尝试清理...')
@@ -186,16 +385,7 @@ def main():
     # 创建锁文件
     create_lock_file()
     
-    # 设置定时任务
-    schedule.every().day.at("09:00").do(start_server)
-    schedule.every().day.at("21:00").do(stop_server)
-    
-    # 只在工作日10:10更新汇率数据
-    schedule.every().monday.at("10:10").do(update_exchange_rate)
-    schedule.every().tuesday.at("10:10").do(update_exchange_rate)
-    schedule.every().wednesday.at("10:10").do(update_exchange_rate)
-    schedule.every().thursday.at("10:10").do(update_exchange_rate)
-    schedule.every().friday.at("10:10").do(update_exchange_rate)
+    setup_schedule()
     
     logging.info('定时任务管理器已启动')
     
@@ -1,329 +1,960 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, abort, g, jsonify, request
 from flask_cors import CORS
-import sqlite3
 import datetime
-import requests
 import json
+import hashlib
+import threading
+import functools
+import gzip
+import queue
+import logging
 import time
-from apscheduler.schedulers.background import BackgroundScheduler
+import atexit
+import csv
+import io
 import os
 from dotenv import load_dotenv
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from backfill import run_backfill, date_range
+import db
+from downsample import lttb_union, ohlc
+import columnar
+import metrics
+from upstream import UpstreamClient
+from upstream_cache import UpstreamCache
+from leader import LeaseElector
+from static_assets import StaticAssets
+from history_store import HistoryStore
 
 # 加载环境变量
 load_dotenv()
 
-app = Flask(__name__, static_folder='.')
-CORS(app, resources={r"/*": {"origins": "*"}})  # 允许所有来源的跨域请求
+# 不使用Flask的静态文件路由（会暴露整个项目目录）：页面和js由static_assets提供
+app = Flask(__name__, static_folder=None)
+CORS(app, resources={r"/*": {"origins": "*"}},  # 允许所有来源的跨域请求
+     expose_headers=['X-Snapshot-Version', 'X-Rates-Seq'])
 
 # 从环境变量获取配置
 PORT = int(os.getenv('PORT', 9088))
 HOST = os.getenv('HOST', '0.0.0.0')
 DB_PATH = os.getenv('DB_PATH', 'exchange_rate.db')
 LOG_PATH = os.getenv('LOG_PATH', 'logs')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 
-# 确保数据库文件所在目录存在
-db_dir = os.path.dirname(DB_PATH)
-if db_dir:  # 只有当路径不是当前目录时才创建
-    os.makedirs(db_dir, exist_ok=True)
+# 配置日志：key=value 形式的结构化字段，LOG_PATH为空时只输出到控制台
+log_handlers = [logging.StreamHandler()]
+if LOG_PATH:
+    os.makedirs(LOG_PATH, exist_ok=True)
+    log_handlers.append(logging.FileHandler(os.path.join(LOG_PATH, 'server.log'), encoding='utf-8'))
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+    handlers=log_handlers
+)
+logger = logging.getLogger('server')
 
-# 汇率API配置
+# 历史数据回填配置
+HISTORY_START_DATE = os.getenv('HISTORY_START_DATE', '2025-04-02')
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 4))
+BACKFILL_RATE = float(os.getenv('BACKFILL_RATE', 5))  # 每秒最多请求数
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', 20))
+
+# 汇率API配置（按优先级排列，首选源响应慢于其p95延迟时对冲请求下一个源）
 EXCHANGE_API_SOURCES = [
-    'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@',
+    'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@{date}/v1/currencies/{currency}.json',
     'https://{date}.currency-api.pages.dev/v1/currencies/{currency}.json'
 ]
+# 可以用逗号分隔的URL模板覆盖（例如性能测试时指向本地的模拟API）
+if os.getenv('EXCHANGE_API_SOURCES'):
+    EXCHANGE_API_SOURCES = os.getenv('EXCHANGE_API_SOURCES').split(',')
+UPSTREAM_TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', 10))
+
+# 上游响应的磁盘缓存：过去日期的文档不会变化，重建数据库时无需再次下载；今天的文档只缓存较短时间
+# UPSTREAM_CACHE_DIR 为空时不使用缓存
+UPSTREAM_CACHE_DIR = os.getenv('UPSTREAM_CACHE_DIR', os.path.join('cache', 'upstream'))
+UPSTREAM_CACHE_MAX_MB = float(os.getenv('UPSTREAM_CACHE_MAX_MB', 200))
+UPSTREAM_CACHE_TODAY_TTL = float(os.getenv('UPSTREAM_CACHE_TODAY_TTL', 600))
+
+upstream_cache = None
+if UPSTREAM_CACHE_DIR:
+    upstream_cache = UpstreamCache(UPSTREAM_CACHE_DIR, max_bytes=int(UPSTREAM_CACHE_MAX_MB * 1024 * 1024),
+                                   today_ttl=UPSTREAM_CACHE_TODAY_TTL)
+upstream = UpstreamClient(EXCHANGE_API_SOURCES, timeout=UPSTREAM_TIMEOUT, cache=upstream_cache)
+
+# 默认跟踪的货币（首次建库时写入货币注册表，之后以注册表为准）及计价货币
+DEFAULT_CURRENCIES = os.getenv('CURRENCIES', 'usd,eur,jpy').split(',')
+BASE_CURRENCY = 'cny'
+
+db.configure(DB_PATH, DEFAULT_CURRENCIES, quote=BASE_CURRENCY)
+
+# 内存映射的历史数据文件，所有工作进程共享，读取时不必从数据库逐行构建；为空时直接读数据库
+# 依赖替换已映射的文件，Windows下默认不启用
+HISTORY_PATH = os.getenv('HISTORY_PATH', '' if os.name == 'nt' else os.path.splitext(DB_PATH)[0] + '.history')
+history_store = None
+if HISTORY_PATH:
+    history_store = HistoryStore(HISTORY_PATH)
+    db.add_write_listener(history_store.on_write)
+
+# /api/rates 查询参数
+RESOLUTIONS = ('day', 'week', 'month')
+MAX_POINTS_LIMIT = 10000
+
+# /api/rates 响应格式（format参数或Accept头选择）
+RESPONSE_FORMATS = {
+    'json': 'application/json',
+    'bin': columnar.MIMETYPE,
+    'arrow': columnar.ARROW_MIMETYPE
+}
+# 小于该字节数的响应不压缩
+COMPRESS_MIN_SIZE = 1024
+
+# 静态资源（页面和js）：预先生成gzip/brotli版本，js使用带内容指纹的URL并长期缓存
+# STATIC_CACHE_DIR 保存压缩结果，为空时每次启动重新压缩
+STATIC_CACHE_DIR = os.getenv('STATIC_CACHE_DIR', os.path.join('cache', 'static'))
+STATIC_MAX_AGE = 365 * 24 * 3600
+static_assets = StaticAssets(app.root_path, cache_dir=STATIC_CACHE_DIR, min_size=COMPRESS_MIN_SIZE)
+
+# 日内采样保留天数，更早的采样在收盘压缩后删除（每日OHLC保留）
+TICK_RETENTION_DAYS = int(os.getenv('TICK_RETENTION_DAYS', 30))
+
+# 多进程部署：调度租约的有效期，以及非调度进程检查数据变化的间隔（秒）
+SCHEDULER_LEASE_TTL = float(os.getenv('SCHEDULER_LEASE_TTL', 30))
+SYNC_INTERVAL = float(os.getenv('SYNC_INTERVAL', 5))
+# 多进程部署时各进程共享指标的目录（/metrics 返回所有进程的合计），为空时只返回处理该请求的进程的指标
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join('cache', 'metrics'))
+
+# 批量换算：每个请求最多的条目数，CSV响应每次输出的行数
+MAX_CONVERT_ITEMS = int(os.getenv('MAX_CONVERT_ITEMS', 200000))
+CONVERT_CSV_CHUNK = 5000
+# 批量查询汇率：每个请求最多的条目数
+MAX_LOOKUP_ITEMS = int(os.getenv('MAX_LOOKUP_ITEMS', 100000))
+
+# 滚动统计的窗口（天）
+STATS_WINDOWS = [int(w) for w in os.getenv('STATS_WINDOWS', '7,30,90').split(',')]
+
+# 汇率数据快照：/api/rates 直接返回该快照，由定时任务在写入后刷新
+_rates_snapshot = None
+_snapshot_lock = threading.Lock()
+
+# 服务器推送（SSE）订阅管理：每个连接一个队列，写入汇率后向所有连接广播变化的行
+class EventBroadcaster:
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.sequence = 0
+    
+    def subscribe(self):
+        q = queue.Queue(maxsize=self.max_pending)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+    
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+    
+    # 广播事件；消费过慢（队列已满）的连接会被断开，客户端重连后重新拉取全量数据
+    def publish(self, event, data):
+        with self.lock:
+            self.sequence += 1
+            message = f"id: {self.sequence}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+            for q in list(self.subscribers):
+                try:
+                    q.put_nowait(message)
+                except queue.Full:
+                    self.subscribers.discard(q)
+                    with q.mutex:
+                        q.queue.clear()
+                    q.put_nowait(None)  # 通知该连接结束
+
+broadcaster = EventBroadcaster()
+SSE_KEEPALIVE_SECONDS = 15
+
+# 汇率写入后推送变化的行
+def publish_rate_changes(rows, is_final):
+    broadcaster.publish('rates', {
+        'is_final': is_final,
+        'rows': [{'date': date, 'rates': rates} for date, rates in rows]
+    })
+
+db.add_write_listener(publish_rate_changes)
+
+# 滚动统计和换算用的最终汇率索引依赖numpy，首次使用时才导入和创建以加快启动；
+# 创建时从数据库整体构建，之后由写入监听器在最终数据追加时增量更新
+_components = {}
+_components_lock = threading.Lock()
+
+def _component(name, factory):
+    instance = _components.get(name)
+    if instance is None:
+        with _components_lock:
+            instance = _components.get(name)
+            if instance is None:
+                instance = factory()
+                db.add_write_listener(instance.on_write)
+                _components[name] = instance
+    return instance
+
+def _create_rolling_stats():
+    from stats import RollingStats
+    return RollingStats(STATS_WINDOWS)
+
+def _create_rate_index():
+    from convert import RateIndex
+    return RateIndex()
+
+def _create_asof_index():
+    from rate_lookup import AsOfIndex
+    return AsOfIndex()
+
+def get_rolling_stats():
+    return _component('rolling_stats', _create_rolling_stats)
+
+def get_rate_index():
+    return _component('rate_index', _create_rate_index)
+
+def get_asof_index():
+    return _component('asof_index', _create_asof_index)
+
+# 启动任务（回填、补全、获取当天数据）在后台执行，进度通过 /api/status 查看
+bootstrap_status = {'state': 'pending', 'phase': None, 'started_at': None, 'finished_at': None, 'backfill': None}
+BOOTSTRAP_SNAPSHOT_INTERVAL = 5  # 回填期间最多每隔多少秒刷新一次快照，让新请求看到已回填的数据
 
 # 数据库初始化
 def init_db():
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        # 创建汇率表，增加eur和jpy字段
-        c.execute('''CREATE TABLE IF NOT EXISTS rates
-                     (date TEXT PRIMARY KEY, 
-                      usd_rate REAL, 
-                      eur_rate REAL,
-                      jpy_rate REAL,
-                      is_final INTEGER DEFAULT 0)''')
-        conn.commit()
-        conn.close()
-        print("数据库初始化成功")
-    except Exception as e:
-        print(f"数据库初始化失败: {e}")
-
-# 获取汇率数据
-def get_exchange_rate(date=None, currency='usd'):
+        db.init_schema()
+        logger.info("数据库初始化成功 path=%s", db.DB_PATH)
+    except Exception:
+        logger.exception("数据库初始化失败 path=%s", db.DB_PATH)
+
+# 一次性获取某日所有货币兑人民币的汇率
+# 只下载一份以人民币为基准的文档（cny.json），取倒数得到各货币的人民币汇率
+def get_exchange_rates(date=None, currencies=None):
+    return fetch_exchange_rates(date, currencies)[0]
+
+# 同get_exchange_rates，返回 (汇率, 来源)，来源为 final（数据库中的最终数据）、cache（上游的磁盘缓存）或 upstream
+def fetch_exchange_rates(date=None, currencies=None):
     try:
         if date is None:
             date = datetime.datetime.now().strftime('%Y-%m-%d')
+        if currencies is None:
+            currencies = db.CURRENCIES
         
-        print(f"尝试获取{date}的{currency.upper()}汇率数据")
+        logger.debug("尝试获取汇率数据 date=%s currencies=%s", date, currencies)
         
         # 首先检查数据库中是否已有最终数据
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(f"SELECT {currency}_rate FROM rates WHERE date = ? AND is_final = 1", (date,))
-        result = c.fetchone()
-        conn.close()
+        final_rates = db.get_final_rates(date, currencies)
+        if final_rates:
+            logger.debug("从数据库获取到最终数据 date=%s", date)
+            return final_rates, 'final'
         
-        if result and result[0] is not None:
-            print(f"从数据库获取到最终数据：日期: {date}, {currency.upper()}汇率: {result[0]}")
-            return [(date, result[0])]
+        data, cached = upstream.fetch(date, BASE_CURRENCY)
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'application/json'
-        }
+        # 文档格式: {"date": ..., "cny": {"usd": 0.137, ...}}，即1人民币可兑换的外币数量
+        if isinstance(data, dict) and isinstance(data.get(BASE_CURRENCY), dict):
+            base_rates = data[BASE_CURRENCY]
+            rates = {}
+            for currency in currencies:
+                value = base_rates.get(currency)
+                if value is not None and float(value) > 0:
+                    rates[currency] = 1 / float(value)
+            if rates:
+                logger.debug("从API获取到数据 date=%s currencies=%d cached=%s", date, len(rates), cached)
+                return rates, 'cache' if cached else 'upstream'
+            logger.warning("API响应数据中缺少所需货币 date=%s currencies=%s", date, currencies)
+        elif data is not None:
+            logger.warning("API响应数据格式不正确，缺少%s字段 date=%s", BASE_CURRENCY, date)
         
-        # 尝试所有API源
-        for api_source in EXCHANGE_API_SOURCES:
-            try:
-                if 'cdn.jsdelivr.net' in api_source:
-                    api_url = f"{api_source}{date}/v1/currencies/{currency}.json"
-                elif 'currency-api.pages.dev' in api_source:
-                    api_url = api_source.format(date=date, currency=currency)
-                
-                print(f"尝试访问API: {api_url}")
-                response = requests.get(api_url, headers=headers, timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    print(f"API响应数据: {data}")
-                    
-                    # 根据API文档处理数据
-                    if isinstance(data, dict):
-                        if currency in data and 'cny' in data[currency]:
-                            rate = float(data[currency]['cny'])
-                            if rate > 0:
-                                print(f"从API获取到数据：日期: {date}, {currency.upper()}汇率: {rate}")
-                                return [(date, rate)]
-                        else:
-                            print(f"API响应数据格式不正确，缺少{currency}或cny字段: {data}")
-                    else:
-                        print(f"API响应数据不是字典格式: {data}")
-                        
-            except Exception as e:
-                print(f"API请求失败 ({api_source}): {e}")
-                continue
-        
-        print(f"所有API源都请求失败，日期: {date}, 货币: {currency}")
-        return None
+        logger.warning("未能获取汇率数据 date=%s", date)
+        return None, None
             
-    except Exception as e:
-        print(f"获取汇率数据失败: {e}")
-        return None
+    except Exception:
+        logger.exception("获取汇率数据失败 date=%s", date)
+        return None, None
+
+# 回填历史数据到昨天，从上次的断点继续（空数据库时从HISTORY_START_DATE开始）
+@metrics.timed(metrics.JOB_DURATION, job='backfill_history')
+def backfill_history():
+    yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    checkpoint = db.get_meta('backfill_checkpoint')
+    if checkpoint:
+        start = datetime.datetime.strptime(checkpoint, '%Y-%m-%d') + datetime.timedelta(days=1)
+    else:
+        start = datetime.datetime.strptime(HISTORY_START_DATE, '%Y-%m-%d')
+    
+    dates = date_range(start, yesterday)
+    if not dates:
+        return
+    logger.info("开始回填历史数据 start=%s end=%s days=%d", dates[0], dates[-1], len(dates))
+    run_backfill(
+        dates,
+        fetch=get_exchange_rates,
+        save_batch=lambda rows: db.upsert_rates(rows, is_final=1),
+        checkpoint=lambda date: db.set_meta('backfill_checkpoint', date),
+        workers=BACKFILL_WORKERS,
+        rate=BACKFILL_RATE,
+        batch_size=BACKFILL_BATCH_SIZE,
+        progress=report_backfill_progress
+    )
+
+# 获取当天汇率并写入数据库，返回是否写入成功
+def save_today_rate(is_final=0):
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    
+    # 当天已标记为最终数据后不再写入：实时更新会把最终数据改回非最终数据
+    if db.get_final_rates(today):
+        logger.debug("当天已有最终数据，跳过 date=%s is_final=%d", today, is_final)
+        return False
+    
+    # 一次请求获取所有货币的汇率
+    rates, origin = fetch_exchange_rates(today)
+    if not rates:
+        return False
+    
+    # 只有实际从上游获取的数据才作为日内采样追加到tick表（当日汇率行会被覆盖，采样不会）；
+    # 磁盘缓存中的文档（今天的缓存有效期内）和数据库中的最终数据都不是新的采样
+    if origin == 'upstream':
+        db.append_ticks(today, rates, datetime.datetime.now().isoformat(timespec='seconds'))
+    db.upsert_rates([(today, rates)], is_final)
+    return True
 
 # 更新当天数据（不标记为最终）
+@metrics.timed(metrics.JOB_DURATION, job='update_today_rate')
 def update_today_rate():
     try:
         today = datetime.datetime.now().strftime('%Y-%m-%d')
         
-        # 获取所有货币的汇率
-        usd_rates = get_exchange_rate(today, 'usd')
-        eur_rates = get_exchange_rate(today, 'eur')
-        jpy_rates = get_exchange_rate(today, 'jpy')
-        
-        if usd_rates or eur_rates or jpy_rates:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # 准备SQL语句
-            sql = "INSERT OR REPLACE INTO rates (date, usd_rate, eur_rate, jpy_rate, is_final) VALUES (?, ?, ?, ?, 0)"
-            values = [today, None, None, None]
-            
-            # 更新各个货币的汇率
-            if usd_rates:
-                values[1] = usd_rates[0][1]
-            if eur_rates:
-                values[2] = eur_rates[0][1]
-            if jpy_rates:
-                values[3] = jpy_rates[0][1]
-            
-            c.execute(sql, values)
-            conn.commit()
-            conn.close()
-            print(f"已更新{today}的实时数据")
+        if save_today_rate(is_final=0):
+            logger.info("已更新实时数据 date=%s", today)
             
             # 同时检查历史数据完整性
             check_and_fill_historical_data()
-    except Exception as e:
-        print(f"更新今日数据失败: {e}")
+            refresh_rates_snapshot()
+    except Exception:
+        logger.exception("更新今日数据失败")
 
 # 将当天数据标记为最终数据
+@metrics.timed(metrics.JOB_DURATION, job='finalize_today_data')
 def finalize_today_data():
     try:
         today = datetime.datetime.now().strftime('%Y-%m-%d')
-        print(f"开始将{today}的数据标记为最终数据")
+        logger.info("开始标记最终数据 date=%s", today)
         
-        # 获取当天最新数据
-        usd_rates = get_exchange_rate(today, 'usd')
-        eur_rates = get_exchange_rate(today, 'eur')
-        jpy_rates = get_exchange_rate(today, 'jpy')
+        if save_today_rate(is_final=1):
+            logger.info("已标记最终数据 date=%s", today)
+            refresh_rates_snapshot()
         
-        if usd_rates or eur_rates or jpy_rates:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # 准备SQL语句
-            sql = "INSERT OR REPLACE INTO rates (date, usd_rate, eur_rate, jpy_rate, is_final) VALUES (?, ?, ?, ?, 1)"
-            values = [today, None, None, None]
-            
-            # 更新各个货币的汇率
-            if usd_rates:
-                values[1] = usd_rates[0][1]
-            if eur_rates:
-                values[2] = eur_rates[0][1]
-            if jpy_rates:
-                values[3] = jpy_rates[0][1]
-            
-            c.execute(sql, values)
-            conn.commit()
-            conn.close()
-            
-            print(f"已将{today}的数据标记为最终数据")
-    except Exception as e:
-        print(f"标记最终数据失败: {e}")
+        # 把当日采样压缩为OHLC，并清理超过保留天数的采样
+        currencies = db.compact_ticks(today)
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=TICK_RETENTION_DAYS)).strftime('%Y-%m-%d')
+        pruned = db.prune_ticks(cutoff)
+        logger.info("日内采样已压缩 date=%s currencies=%d pruned=%d", today, currencies, pruned)
+    except Exception:
+        logger.exception("标记最终数据失败")
 
-# 获取历史汇率数据
+# 读取日期范围内的汇率，返回 (日期列表, {货币: 汇率列表})；优先使用历史数据文件，不可用时读数据库
+def load_series(start, end, currencies):
+    if history_store is not None:
+        loaded = history_store.read(start, end, currencies)
+        if loaded is not None:
+            return loaded
+    rows = db.load_rates_range(start, end, currencies)
+    return [row[0] for row in rows], {currency: [row[i + 1] for row in rows] for i, currency in enumerate(currencies)}
+
+# 获取历史汇率数据（只读数据库，不访问上游API）
 def get_historical_rates():
     try:
-        # 首先获取当天的实时数据
-        today = datetime.datetime.now().strftime('%Y-%m-%d')
-        print(f"获取当天({today})的实时数据...")
-        
-        # 获取所有货币的汇率
-        usd_rates = get_exchange_rate(today, 'usd')
-        eur_rates = get_exchange_rate(today, 'eur')
-        jpy_rates = get_exchange_rate(today, 'jpy')
-        
-        if usd_rates or eur_rates or jpy_rates:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # 准备SQL语句
-            sql = "INSERT OR REPLACE INTO rates (date, usd_rate, eur_rate, jpy_rate, is_final) VALUES (?, ?, ?, ?, 0)"
-            values = [today, None, None, None]
-            
-            # 更新各个货币的汇率
-            if usd_rates:
-                values[1] = usd_rates[0][1]
-            if eur_rates:
-                values[2] = eur_rates[0][1]
-            if jpy_rates:
-                values[3] = jpy_rates[0][1]
-            
-            c.execute(sql, values)
-            conn.commit()
-            conn.close()
-            print(f"已更新当天({today})的实时数据")
+        dates, series = load_series(None, None, db.CURRENCIES)
         
-        # 获取所有历史数据
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT date, usd_rate, eur_rate, jpy_rate FROM rates ORDER BY date")
-        data = c.fetchall()
-        conn.close()
-        
-        dates = [row[0] for row in data]
-        usd_rates = [row[1] for row in data]
-        eur_rates = [row[2] for row in data]
-        jpy_rates = [row[3] for row in data]
+        result = {'dates': dates}
+        for currency in db.CURRENCIES:
+            result[f'{currency}_rates'] = series[currency]
+        return result
+    except Exception:
+        logger.exception("获取历史数据失败")
+        result = {'dates': []}
+        for currency in db.CURRENCIES:
+            result[f'{currency}_rates'] = []
+        return result
+
+# 重新生成汇率数据快照（数据版本号、内容摘要和变化序号）
+def refresh_rates_snapshot():
+    global _rates_snapshot
+    with _snapshot_lock:
+        # 先读取变化序号再读数据，快照至少包含该序号之前的所有变化
+        seq = db.current_seq()
+        data = get_historical_rates()
+        etag = hashlib.sha1(json.dumps(data, separators=(',', ':')).encode('utf-8')).hexdigest()
+        # 快照只保存版本号：响应体在需要时从历史数据文件生成，编码后的结果由render_rates缓存，不在进程内另存一份全量数据
+        if _rates_snapshot is None or _rates_snapshot['etag'] != etag:
+            version = _rates_snapshot['version'] + 1 if _rates_snapshot else 1
+            _rates_snapshot = {'version': version, 'etag': etag, 'seq': seq}
+            logger.info("汇率数据快照已刷新 version=%d dates=%d seq=%d", version, len(data['dates']), seq)
+        elif _rates_snapshot['seq'] != seq:
+            _rates_snapshot = dict(_rates_snapshot, seq=seq)
+        return _rates_snapshot
+
+# 获取当前快照，首次访问时生成
+def get_rates_snapshot():
+    snapshot = _rates_snapshot
+    if snapshot is None:
+        snapshot = refresh_rates_snapshot()
+    return snapshot
+
+# 解析 /api/rates 的查询参数，参数不合法时抛出ValueError
+# 没有任何参数时返回None，表示直接使用全量快照
+def parse_rates_query(args):
+    if not any(args.get(name) for name in ('from', 'to', 'currency', 'resolution', 'max_points')):
+        return None
+    
+    start = args.get('from') or None
+    end = args.get('to') or None
+    for value in (start, end):
+        if value is not None:
+            try:
+                datetime.datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f"日期格式应为 YYYY-MM-DD: {value}")
+    
+    currencies = db.CURRENCIES
+    if args.get('currency'):
+        currencies = [c.strip().lower() for c in args['currency'].split(',') if c.strip()]
+        unknown = [c for c in currencies if c not in db.CURRENCIES]
+        if unknown or not currencies:
+            raise ValueError(f"不支持的货币: {','.join(unknown)}")
+    
+    resolution = args.get('resolution') or 'day'
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution 只能是 {', '.join(RESOLUTIONS)}")
+    
+    max_points = args.get('max_points')
+    if max_points:
+        if not max_points.isdigit():
+            raise ValueError("max_points 必须是整数")
+        max_points = int(max_points)
+        if not 3 <= max_points <= MAX_POINTS_LIMIT:
+            raise ValueError(f"max_points 必须在 3 到 {MAX_POINTS_LIMIT} 之间")
+    else:
+        max_points = None
+    
+    return start, end, tuple(currencies), resolution, max_points
+
+# 按范围/货币/分辨率生成汇率数据，返回结果字典（不缓存，由render_rates缓存编码后的响应体）
+def build_rates_range(start, end, currencies, resolution, max_points):
+    dates, series = load_series(start, end, currencies)
+    result = {}
+    
+    # 按周/月聚合为OHLC，收盘价作为该周期的汇率
+    if resolution != 'day':
+        periods = dates
+        for currency in currencies:
+            periods, buckets = ohlc(dates, series[currency], resolution)
+            result[f'{currency}_ohlc'] = buckets
+            series[currency] = [bucket[3] if bucket else None for bucket in buckets]
+        dates = periods
+    
+    # LTTB降采样：取所有货币选中点的并集，总点数接近且不超过max_points
+    if max_points and len(dates) > max_points:
+        x = [datetime.date.fromisoformat(d).toordinal() for d in dates]
+        keep = lttb_union(x, [series[currency] for currency in currencies], max_points)
+        dates = [dates[i] for i in keep]
+        for currency in currencies:
+            series[currency] = [series[currency][i] for i in keep]
+            if f'{currency}_ohlc' in result:
+                result[f'{currency}_ohlc'] = [result[f'{currency}_ohlc'][i] for i in keep]
+    
+    result['dates'] = dates
+    for currency in currencies:
+        result[f'{currency}_rates'] = series[currency]
+    return result
+
+# 选择响应格式：format参数优先，其次是Accept头，默认JSON
+def negotiate_format(req):
+    fmt = req.args.get('format')
+    if fmt:
+        if fmt not in RESPONSE_FORMATS:
+            raise ValueError(f"format 只能是 {', '.join(RESPONSE_FORMATS)}")
+        return fmt
+    best = req.accept_mimetypes.best_match(list(RESPONSE_FORMATS.values()), default='application/json')
+    return next(name for name, mimetype in RESPONSE_FORMATS.items() if mimetype == best)
+
+# 选择压缩方式：优先brotli（已安装时），其次gzip
+def negotiate_encoding(req):
+    if brotli is not None and req.accept_encodings['br']:
+        return 'br'
+    if req.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+# 按格式和压缩方式序列化汇率数据，返回 (响应体, ETag, 实际使用的压缩方式)
+# params为None时使用全量快照
+@functools.lru_cache(maxsize=128)
+def render_rates(version, params, fmt, encoding):
+    body = None
+    if fmt == 'bin' and history_store is not None and (params is None or params[3:] == ('day', None)):
+        # 按日的原始数据直接从映射的历史数据文件编码
+        start, end, currencies = params[:3] if params else (None, None, db.CURRENCIES)
+        body = history_store.encode(start, end, currencies)
+    
+    if body is None:
+        # 全量数据从历史数据文件读取，只在生成响应体时临时使用
+        data = get_historical_rates() if params is None else build_rates_range(*params)
         
-        return {
-            'dates': dates,
-            'usd_rates': usd_rates,
-            'eur_rates': eur_rates,
-            'jpy_rates': jpy_rates
-        }
-    except Exception as e:
-        print(f"获取历史数据失败: {e}")
-        return {'dates': [], 'usd_rates': [], 'eur_rates': [], 'jpy_rates': []}
+        if fmt == 'bin':
+            body = columnar.encode(data['dates'], columnar.rates_columns(data))
+        elif fmt == 'arrow':
+            body = columnar.encode_arrow(data['dates'], columnar.rates_columns(data))
+        else:
+            body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    
+    if encoding and len(body) >= COMPRESS_MIN_SIZE:
+        if encoding == 'br':
+            body = brotli.compress(body)
+        else:
+            body = gzip.compress(body)
+        etag = f"{etag}-{encoding}"
+    else:
+        encoding = None
+    return body, etag, encoding
 
 # 检查并补充历史数据
+# 完整性水位（complete_through）之前的日期都已完整，只检查水位之后的日期，
+# 数据完整时这里只有一次很小的SQL查询
+@metrics.timed(metrics.JOB_DURATION, job='check_and_fill')
 def check_and_fill_historical_data():
     try:
-        print("\n开始检查历史数据完整性...")
-        # 获取昨天的日期
-        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
-        start_date = datetime.datetime(2025, 4, 2)
-        end_date = yesterday  # 只检查到昨天
+        # 只检查到昨天
+        end = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        watermark = db.get_meta('complete_through')
+        if watermark:
+            start = (datetime.datetime.strptime(watermark, '%Y-%m-%d') + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        else:
+            start = HISTORY_START_DATE
+        if start > end:
+            return
         
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        logger.info("开始检查历史数据完整性 start=%s end=%s", start, end)
+        existing_data = db.find_missing_dates(start, end)
+        remaining = []
         
-        # 获取所有已存在的数据
-        c.execute("SELECT date, usd_rate, eur_rate, jpy_rate FROM rates WHERE date <= ?", (yesterday.strftime('%Y-%m-%d'),))
-        existing_data = {row[0]: {'usd': row[1], 'eur': row[2], 'jpy': row[3]} for row in c.fetchall()}
-        
-        print(f"已存在的数据日期: {sorted(list(existing_data.keys()))}")
-        
-        # 检查每一天的数据
-        current_date = start_date
-        while current_date <= end_date:
-            date_str = current_date.strftime('%Y-%m-%d')
-            needs_update = False
-            values = [date_str, None, None, None]
-            
-            if date_str not in existing_data:
-                print(f"\n发现缺失日期：{date_str}，开始获取所有货币数据...")
-                needs_update = True
-            else:
-                # 检查每个货币的数据是否存在
-                if existing_data[date_str]['usd'] is None:
-                    print(f"\n发现{date_str}的USD数据缺失，尝试获取...")
-                    needs_update = True
-                if existing_data[date_str]['eur'] is None:
-                    print(f"\n发现{date_str}的EUR数据缺失，尝试获取...")
-                    needs_update = True
-                if existing_data[date_str]['jpy'] is None:
-                    print(f"\n发现{date_str}的JPY数据缺失，尝试获取...")
-                    needs_update = True
+        if existing_data:
+            logger.info("发现缺失或不完整的日期 count=%d first=%s", len(existing_data), min(existing_data))
             
-            if needs_update:
-                # 获取所有货币的汇率
-                usd_rates = get_exchange_rate(date_str, 'usd')
-                eur_rates = get_exchange_rate(date_str, 'eur')
-                jpy_rates = get_exchange_rate(date_str, 'jpy')
-                
-                # 如果日期已存在，保留现有的非空值
-                if date_str in existing_data:
-                    values[1] = existing_data[date_str]['usd']
-                    values[2] = existing_data[date_str]['eur']
-                    values[3] = existing_data[date_str]['jpy']
-                
-                # 更新缺失的汇率
-                if usd_rates:
-                    values[1] = usd_rates[0][1]
-                if eur_rates:
-                    values[2] = eur_rates[0][1]
-                if jpy_rates:
-                    values[3] = jpy_rates[0][1]
-                
-                # 只有在有新数据时才更新数据库
-                if any(v is not None for v in values[1:]):
-                    c.execute("INSERT OR REPLACE INTO rates (date, usd_rate, eur_rate, jpy_rate, is_final) VALUES (?, ?, ?, ?, 1)", values)
-                    conn.commit()
-                    print(f"已更新{date_str}的数据: USD={values[1]}, EUR={values[2]}, JPY={values[3]}")
-                else:
-                    print(f"未能获取{date_str}的任何新数据")
+            # 如果日期已存在，保留现有的非空值，只补充缺失的汇率
+            def fetch_missing(date_str):
+                fetched = get_exchange_rates(date_str)
+                if not fetched:
+                    return None
+                values = {currency: rate for currency, rate in existing_data[date_str].items() if rate is not None}
+                values.update(fetched)
+                return values
             
-            current_date += datetime.timedelta(days=1)
-            time.sleep(1)  # 避免请求过于频繁
+            run_backfill(
+                sorted(existing_data),
+                fetch=fetch_missing,
+                save_batch=lambda rows: db.upsert_rates(rows, is_final=1),
+                workers=BACKFILL_WORKERS,
+                rate=BACKFILL_RATE,
+                batch_size=BACKFILL_BATCH_SIZE,
+                progress=report_backfill_progress
+            )
+            # 补充后重新检查，获取失败或仍有货币为空的日期视为未完整
+            remaining = list(db.find_missing_dates(start, end))
         
-        conn.close()
-        print("历史数据完整性检查完成")
-    except Exception as e:
-        print(f"检查历史数据完整性时出错: {e}")
+        # 水位推进到第一个仍缺失日期的前一天
+        if remaining:
+            first_missing = datetime.datetime.strptime(min(remaining), '%Y-%m-%d')
+            new_watermark = (first_missing - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        else:
+            new_watermark = end
+        if new_watermark != watermark and new_watermark >= HISTORY_START_DATE:
+            db.set_meta('complete_through', new_watermark)
+        
+        logger.info("历史数据完整性检查完成 watermark=%s remaining=%d", new_watermark, len(remaining))
+    except Exception:
+        logger.exception("检查历史数据完整性时出错")
+
+# 调用带lru_cache的函数，并按命中计数变化记录缓存命中/未命中
+def cached_call(name, func, *args):
+    hits = func.cache_info().hits
+    result = func(*args)
+    metrics.CACHE_REQUESTS.inc(cache=name, result='hit' if func.cache_info().hits > hits else 'miss')
+    return result
+
+# 处理条件请求，并记录客户端缓存（ETag）是否命中
+def conditional_response(response, name):
+    response = response.make_conditional(request)
+    metrics.CACHE_REQUESTS.inc(cache=name, result='hit' if response.status_code == 304 else 'miss')
+    return response
+
+# 记录每个请求的处理耗时（按路由模板分组，避免标签数量随URL增长）
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, status=response.status_code)
+    return response
+
+# 静态文件路由：带指纹的URL长期缓存（immutable），其他URL（页面、不带指纹的js）每次用ETag验证
+@app.route('/')
+def serve_index():
+    return serve_static('index.html')
 
-# 静态文件路由
 @app.route('/js/<path:filename>')
 def serve_js(filename):
-    return send_from_directory('js', filename)
+    return serve_static(f'js/{filename}')
+
+def serve_static(path):
+    asset = static_assets.get(path)
+    if asset is None:
+        abort(404)
+    body, encoding = asset.body(negotiate_encoding(request))
+    response = app.response_class(body, mimetype=asset.mimetype)
+    response.set_etag(asset.etag(encoding))
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if static_assets.is_immutable(path):
+        response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return conditional_response(response, 'static_etag')
 
-# API路由：获取所有汇率数据
+# API路由：获取汇率数据（支持ETag/304）
+# 可选参数：from、to（YYYY-MM-DD）、currency（如 usd,eur）、resolution（day/week/month）、max_points、
+# format（json/bin/arrow，也可用Accept头选择）；支持gzip/brotli压缩
+# 响应头 X-Rates-Seq 为数据对应的变化序号，之后可用 since=<序号> 只获取变化的数据
 @app.route('/api/rates', methods=['GET'])
 def get_rates():
-    return jsonify(get_historical_rates())
+    if request.args.get('since') is not None:
+        return get_rate_changes(request.args)
+    try:
+        params = parse_rates_query(request.args)
+        fmt = negotiate_format(request)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    snapshot = get_rates_snapshot()
+    try:
+        body, etag, encoding = cached_call('render_rates', render_rates,
+                                           snapshot['version'], params, fmt, negotiate_encoding(request))
+    except ImportError:
+        return jsonify({'status': 'error', 'message': '服务器未安装pyarrow，不支持arrow格式'}), 406
+    
+    response = app.response_class(body, mimetype=RESPONSE_FORMATS[fmt])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Snapshot-Version'] = str(snapshot['version'])
+    response.headers['X-Rates-Seq'] = str(snapshot['seq'])
+    return conditional_response(response, 'rates_etag')
+
+# 增量同步：返回变化序号大于since的日期（该日所有货币的当前值），客户端按日期覆盖已有数据，
+# 再用返回的seq作为下一次的since；since大于当前序号（数据库已重建）时返回reset，客户端应重新获取全量数据
+# 可选参数：from、to（YYYY-MM-DD，只返回范围内的日期）、currency（如 usd,eur）；按天返回，不支持resolution和max_points
+def get_rate_changes(args):
+    since = args['since']
+    if not since.isdigit():
+        return jsonify({'status': 'error', 'message': 'since 必须是非负整数'}), 400
+    try:
+        params = parse_rates_query(args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    start, end, currencies, resolution, max_points = params or (None, None, tuple(db.CURRENCIES), 'day', None)
+    if resolution != 'day' or max_points:
+        return jsonify({'status': 'error', 'message': '增量同步（since）不支持 resolution 和 max_points'}), 400
+    
+    # 先读取序号再读数据，期间新写入的行在下一次同步时会再返回一次（按日期覆盖，不影响结果）
+    seq = db.current_seq()
+    since = int(since)
+    if since > seq:
+        return jsonify({'seq': seq, 'reset': True, 'rows': []})
+    rows = db.load_changes_since(since, currencies, start, end) if since < seq else []
+    response = jsonify({
+        'seq': seq,
+        'reset': False,
+        'rows': [{'date': date, 'is_final': is_final,
+                  'rates': {currency: rate for currency, rate in zip(currencies, rates) if rate is not None}}
+                 for date, is_final, *rates in rows]
+    })
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# 生成统计结果，返回 (响应体, ETag)，以统计版本作为缓存键的一部分
+@functools.lru_cache(maxsize=64)
+def render_stats(version, start, end, currencies):
+    body = json.dumps(get_rolling_stats().query(start, end, list(currencies)), separators=(',', ':'))
+    return body, hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+# API路由：滚动统计（日涨跌幅、移动平均、波动率、区间最高/最低）
+# 可选参数：from、to（YYYY-MM-DD）、currency（如 usd,eur）
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    try:
+        params = parse_rates_query(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    start, end, currencies = params[:3] if params else (None, None, tuple(db.CURRENCIES))
+    
+    rolling_stats = get_rolling_stats()
+    rolling_stats.refresh_if_needed()
+    body, etag = cached_call('render_stats', render_stats, rolling_stats.version, start, end, currencies)
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return conditional_response(response, 'stats_etag')
+
+# API路由：由日内采样得到的每日开盘/最高/最低/收盘价和采样次数
+# 可选参数：from、to（YYYY-MM-DD）、currency（如 usd,eur）
+@app.route('/api/ohlc', methods=['GET'])
+def get_daily_ohlc():
+    try:
+        params = parse_rates_query(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    start, end, currencies = params[:3] if params else (None, None, tuple(db.CURRENCIES))
+    
+    dates = []
+    index = {}
+    result = {currency: {'open': [], 'high': [], 'low': [], 'close': [], 'samples': []} for currency in currencies}
+    for date, base, *bar in db.load_daily_ohlc(start, end, currencies):
+        if date not in index:
+            index[date] = len(dates)
+            dates.append(date)
+            for series in result.values():
+                for values in series.values():
+                    values.append(None)
+        for name, value in zip(('open', 'high', 'low', 'close', 'samples'), bar):
+            result[base][name][index[date]] = value
+    result['dates'] = dates
+    
+    body = json.dumps(result, separators=(',', ':'))
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body.encode('utf-8')).hexdigest())
+    response.headers['Cache-Control'] = 'no-cache'
+    return conditional_response(response, 'ohlc_etag')
+
+# API路由：服务器推送汇率变化（Server-Sent Events）
+@app.route('/api/stream', methods=['GET'])
+def stream_rates():
+    q = broadcaster.subscribe()
+    
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    message = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            broadcaster.unsubscribe(q)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# 读取换算请求，返回按列的 {'amount', 'from', 'to', 'date'}，参数不合法时抛出ValueError
+# JSON：记录数组 [{"amount": 100, "from": "usd", "to": "jpy", "date": "2025-05-01"}, ...]、{"items": [...]}
+#       或按列的 {"amount": [...], "from": [...], "to": [...], "date": [...]}
+# CSV（Content-Type: text/csv）：表头为 amount,from,to,date，逐行读取请求体
+# to缺省为计价货币（人民币），date缺省为最新的最终数据
+def parse_convert_request(req):
+    fields = ('amount', 'from', 'to', 'date')
+    columns = {field: [] for field in fields}
+    if req.mimetype == 'text/csv':
+        reader = csv.DictReader(io.TextIOWrapper(req.stream, encoding='utf-8-sig', newline=''))
+        if not reader.fieldnames or 'amount' not in reader.fieldnames or 'from' not in reader.fieldnames:
+            raise ValueError('CSV表头至少需要包含amount和from列')
+        for row in reader:
+            if len(columns['amount']) >= MAX_CONVERT_ITEMS:
+                raise ValueError(f'每次最多换算{MAX_CONVERT_ITEMS}条')
+            for field in fields:
+                columns[field].append(row.get(field) or '')
+    else:
+        payload = req.get_json(silent=True)
+        if isinstance(payload, dict) and 'items' in payload:
+            payload = payload['items']
+        if isinstance(payload, dict) and isinstance(payload.get('amount'), list):
+            count = len(payload['amount'])
+            for field in fields:
+                values = payload.get(field)
+                if values is None:
+                    values = [''] * count
+                if not isinstance(values, list) or len(values) != count:
+                    raise ValueError(f'{field}的数量与amount不一致')
+                columns[field] = values
+        elif isinstance(payload, list):
+            if not all(isinstance(item, dict) for item in payload):
+                raise ValueError('items中的每一项都必须是对象')
+            columns['amount'] = [item.get('amount') for item in payload]
+            for field in fields[1:]:
+                columns[field] = [item.get(field) or '' for item in payload]
+        else:
+            raise ValueError('请求体必须是JSON数组、{"items": [...]}、按列的JSON对象或CSV')
+    if len(columns['amount']) > MAX_CONVERT_ITEMS:
+        raise ValueError(f'每次最多换算{MAX_CONVERT_ITEMS}条')
+    columns['to'] = [value or BASE_CURRENCY for value in columns['to']]
+    columns['date'] = [value or '' for value in columns['date']]
+    return columns
+
+# 解析查询汇率的参数：currency（须为已跟踪的货币）、date（YYYY-MM-DD，空表示最新的最终数据），参数不合法时抛出ValueError
+def parse_lookup_item(currency, date):
+    currency = str(currency or '').strip().lower()
+    if currency not in db.CURRENCIES:
+        raise ValueError(f'不支持的货币: {currency}')
+    date = str(date or '').strip() or None
+    if date is not None:
+        try:
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError(f'日期格式应为 YYYY-MM-DD: {date}')
+    return currency, date
+
+def parse_bool(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes')
+
+# API路由：查询某日的汇率（对人民币），只使用最终数据
+# 参数：currency（如 usd）、date（YYYY-MM-DD，缺省为最新）、asof（true时该日没有数据则使用之前最近一天的汇率）
+@app.route('/api/rate', methods=['GET'])
+def lookup_rate():
+    try:
+        currency, date = parse_lookup_item(request.args.get('currency'), request.args.get('date'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    asof = parse_bool(request.args.get('asof', ''))
+    found = get_asof_index().lookup(currency, date, asof)
+    if found is None:
+        message = '该日期没有最终汇率' if not asof else '该日期之前没有最终汇率'
+        return jsonify({'status': 'error', 'message': message}), 404
+    rate, rate_date = found
+    return jsonify({'currency': currency, 'quote': BASE_CURRENCY, 'date': date or rate_date,
+                    'rate': rate, 'rate_date': rate_date, 'asof': asof})
+
+# API路由：批量查询汇率
+# 请求体：{"asof": true, "items": [{"currency": "usd", "date": "2025-05-03"}, ...]}、记录数组，
+#       或按列的 {"asof": true, "currency": [...], "date": [...]}
+# 按列返回 rate、rate_date（查不到的为null）和 errors
+@app.route('/api/rate/batch', methods=['POST'])
+def lookup_rates():
+    payload = request.get_json(silent=True)
+    asof = False
+    if isinstance(payload, dict):
+        asof = parse_bool(payload.get('asof', ''))
+        if 'items' in payload:
+            payload = payload['items']
+    if isinstance(payload, dict) and isinstance(payload.get('currency'), list):
+        currencies = payload['currency']
+        dates = payload.get('date')
+        if dates is None:
+            dates = [''] * len(currencies)
+        if not isinstance(dates, list) or len(dates) != len(currencies):
+            return jsonify({'status': 'error', 'message': 'date的数量与currency不一致'}), 400
+    elif isinstance(payload, list) and all(isinstance(item, dict) for item in payload):
+        currencies = [item.get('currency') for item in payload]
+        dates = [item.get('date') for item in payload]
+    else:
+        return jsonify({'status': 'error', 'message': '请求体必须是JSON数组、{"items": [...]}或按列的JSON对象'}), 400
+    if len(currencies) > MAX_LOOKUP_ITEMS:
+        return jsonify({'status': 'error', 'message': f'每次最多查询{MAX_LOOKUP_ITEMS}条'}), 400
+    
+    index = get_asof_index()
+    rates = []
+    rate_dates = []
+    errors = []
+    for i, (currency, date) in enumerate(zip(currencies, dates)):
+        found = None
+        try:
+            found = index.lookup(*parse_lookup_item(currency, date), asof)
+            if found is None:
+                errors.append({'index': i, 'message': '该日期之前没有最终汇率' if asof else '该日期没有最终汇率'})
+        except ValueError as e:
+            errors.append({'index': i, 'message': str(e)})
+        rates.append(found[0] if found else None)
+        rate_dates.append(found[1] if found else None)
+    return jsonify({'count': len(rates), 'quote': BASE_CURRENCY, 'asof': asof,
+                    'rate': rates, 'rate_date': rate_dates, 'errors': errors})
+
+# numpy数组转为可JSON序列化的列表，NaN转为None
+def _json_floats(values):
+    import numpy as np
+    return [None if v != v else v for v in np.round(values, 8).tolist()]
+
+# 日期数组（datetime64）转为字符串列表，NaT转为None；先去重再格式化
+def _json_dates(values):
+    import numpy as np
+    days, inverse = np.unique(values, return_inverse=True)
+    strings = [None if d == 'NaT' else d for d in days.astype(str).tolist()]
+    return [strings[i] for i in inverse.tolist()]
+
+# API路由：批量换算（JSON或CSV），日期为周末/节假日等没有最终数据的日子时使用之前最近的最终数据
+# 响应按列返回 result、rate、rate_date（无法换算的为null）及 errors [{index, message}]；CSV请求返回CSV
+@app.route('/api/convert', methods=['POST'])
+def convert_rates():
+    try:
+        columns = parse_convert_request(request)
+        converted, errors = get_rate_index().convert(columns['amount'], columns['from'], columns['to'], columns['date'])
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    rate_dates = _json_dates(converted['rate_date'])
+    
+    if request.mimetype != 'text/csv' and request.accept_mimetypes.best != 'text/csv':
+        return jsonify({
+            'count': len(rate_dates),
+            'quote': BASE_CURRENCY,
+            'result': _json_floats(converted['result']),
+            'rate': _json_floats(converted['rate']),
+            'rate_date': rate_dates,
+            'errors': [{'index': index, 'message': message} for index, message in errors]
+        })
+    
+    # CSV：在输入列之后追加 rate_date、rate、result、error，分块输出
+    messages = {}
+    for index, message in errors:
+        messages.setdefault(index, message)
+    results = _json_floats(converted['result'])
+    rates = _json_floats(converted['rate'])
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['amount', 'from', 'to', 'date', 'rate_date', 'rate', 'result', 'error'])
+        for start in range(0, len(results), CONVERT_CSV_CHUNK):
+            for i in range(start, min(start + CONVERT_CSV_CHUNK, len(results))):
+                writer.writerow([columns['amount'][i], columns['from'][i], columns['to'][i], columns['date'][i],
+                                 rate_dates[i] or '', '' if rates[i] is None else rates[i],
+                                 '' if results[i] is None else results[i], messages.get(i, '')])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if not results:
+            yield buffer.getvalue()
+    
+    return Response(generate(), mimetype='text/csv')
+
+# 监控指标（Prometheus文本格式）
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 # API路由：更新今日汇率数据
 @app.route('/api/update', methods=['POST'])
@@ -331,67 +962,165 @@ def update_rates():
     update_today_rate()
     return jsonify({'status': 'success'})
 
-if __name__ == '__main__':
-    init_db()  # 初始化数据库
-    
-    # 获取历史数据（如果数据库为空）
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM rates")
-    count = c.fetchone()[0]
-    conn.close()
-    
-    if count == 0:
-        print("\n数据库为空，开始获取历史数据...")
-        # 获取昨天的日期
-        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
-        start_date = datetime.datetime(2025, 4, 2)
-        end_date = yesterday
-        current_date = start_date
+# API路由：服务状态（启动任务进度、已有数据范围、上游API状态）
+@app.route('/api/status', methods=['GET'])
+def get_status():
+    first_date, last_date, days = db.date_bounds()
+    checkpoint = db.get_meta('backfill_checkpoint')
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    history_start = datetime.date.fromisoformat(HISTORY_START_DATE)
+    total_days = max((yesterday - history_start).days + 1, 1)
+    backfilled_days = (datetime.date.fromisoformat(checkpoint) - history_start).days + 1 if checkpoint else 0
+    if elector is None:
+        role = 'standalone'
+    else:
+        role = 'leader' if elector.is_leader else 'follower'
+    snapshot = _rates_snapshot
+    return jsonify({
+        'role': role,
+        'bootstrap': bootstrap_status,
+        # 回填断点和完整性水位保存在数据库中，多进程部署时非调度进程也能看到进度
+        'history': {
+            'start': HISTORY_START_DATE,
+            'backfill_checkpoint': checkpoint,
+            'backfill_progress': round(min(max(backfilled_days / total_days, 0), 1), 4),
+            'complete_through': db.get_meta('complete_through')
+        },
+        'data': {
+            'first_date': first_date,
+            'last_date': last_date,
+            'days': days,
+            'snapshot_version': snapshot['version'] if snapshot else None
+        },
+        'upstream': upstream.status()
+    })
+
+# 回填每批完成后更新进度，并定期刷新快照
+_last_progress_refresh = 0.0
+
+def report_backfill_progress(progress):
+    global _last_progress_refresh
+    bootstrap_status['backfill'] = progress
+    if bootstrap_status['state'] == 'running' and \
+            time.monotonic() - _last_progress_refresh >= BOOTSTRAP_SNAPSHOT_INTERVAL:
+        _last_progress_refresh = time.monotonic()
+        refresh_rates_snapshot()
+
+# 启动时的数据准备
+def run_startup_tasks():
+    bootstrap_status.update(state='running', started_at=datetime.datetime.now().isoformat(timespec='seconds'),
+                            finished_at=None)
+    try:
+        # 回填历史数据（空数据库时全部获取，中断后从断点继续）
+        bootstrap_status['phase'] = 'backfill'
+        backfill_history()
         
-        while current_date <= end_date:
-            date_str = current_date.strftime('%Y-%m-%d')
-            print(f"\n正在获取{date_str}的数据...")
-            
-            # 获取所有货币的汇率
-            usd_rates = get_exchange_rate(date_str, 'usd')
-            eur_rates = get_exchange_rate(date_str, 'eur')
-            jpy_rates = get_exchange_rate(date_str, 'jpy')
-            
-            if usd_rates or eur_rates or jpy_rates:
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                # 将历史数据标记为最终数据
-                sql = "INSERT OR REPLACE INTO rates (date, usd_rate, eur_rate, jpy_rate, is_final) VALUES (?, ?, ?, ?, 1)"
-                values = [date_str, None, None, None]
-                
-                # 更新各个货币的汇率
-                if usd_rates:
-                    values[1] = usd_rates[0][1]
-                if eur_rates:
-                    values[2] = eur_rates[0][1]
-                if jpy_rates:
-                    values[3] = jpy_rates[0][1]
-                
-                c.execute(sql, values)
-                conn.commit()
-                conn.close()
-                print(f"已保存{date_str}的数据")
-            else:
-                print(f"未能获取{date_str}的数据")
-            current_date += datetime.timedelta(days=1)
-            time.sleep(1)  # 避免请求过于频繁
-    
-    # 检查并补充历史数据（只检查到昨天）
-    check_and_fill_historical_data()
-    
-    # 设置定时任务
+        # 检查并补充历史数据（只检查到昨天）
+        bootstrap_status['phase'] = 'check_and_fill'
+        check_and_fill_historical_data()
+        
+        # 获取当天实时数据并生成快照
+        bootstrap_status['phase'] = 'today'
+        try:
+            save_today_rate(is_final=0)
+        except Exception:
+            logger.exception("获取当天实时数据失败")
+        refresh_rates_snapshot()
+        bootstrap_status['state'] = 'done'
+    except Exception:
+        logger.exception("启动任务失败")
+        bootstrap_status['state'] = 'failed'
+    bootstrap_status.update(phase=None, finished_at=datetime.datetime.now().isoformat(timespec='seconds'))
+
+# 创建定时任务
+def create_scheduler():
+    from apscheduler.schedulers.background import BackgroundScheduler
     scheduler = BackgroundScheduler()
     # 每天20:00将当天数据标记为最终数据
     scheduler.add_job(finalize_today_data, 'cron', hour=20, minute=0)
     # 每小时更新一次当天实时数据，同时检查历史数据完整性
     scheduler.add_job(update_today_rate, 'interval', hours=1)
-    scheduler.start()
+    return scheduler
+
+# 多进程部署（见wsgi.py）：每个工作进程都提供读服务，只有持有调度租约的进程运行启动任务和定时任务
+_scheduler = None
+_scheduler_lock = threading.Lock()
+elector = None
+
+def start_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = create_scheduler()
+            _scheduler.start()
+            logger.info("定时任务已启动 pid=%d", os.getpid())
+
+def stop_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.shutdown(wait=False)
+            _scheduler = None
+            logger.info("定时任务已停止 pid=%d", os.getpid())
+
+# 在后台执行启动任务，完成后启动定时任务（多进程部署时只在仍持有调度租约时启动）
+def start_bootstrap():
+    def bootstrap():
+        run_startup_tasks()
+        if elector is None or elector.is_leader:
+            start_scheduler()
+    threading.Thread(target=bootstrap, name='bootstrap', daemon=True).start()
+
+# 获得调度租约后执行启动任务（期间照常续约）
+def on_scheduler_elected():
+    start_bootstrap()
+
+# 定期检查汇率数据版本，其他进程写入后刷新本进程的快照和统计，并通知SSE客户端重新拉取
+def watch_external_writes():
+    version = db.current_seq()
+    while True:
+        time.sleep(SYNC_INTERVAL)
+        try:
+            current = db.current_seq()
+            if current == version:
+                continue
+            previous, version = version, current
+            # 期间的每个版本都是本进程写入的才跳过（已由写入监听器处理），其中有其他进程的写入时都要刷新
+            local = db.pop_local_versions(current)
+            if current > previous and all(v in local for v in range(previous + 1, current + 1)):
+                continue
+            for component in list(_components.values()):
+                component.dirty = True
+            # 写入的进程不一定会重新生成历史数据文件，本进程也要重新生成，否则快照基于旧文件，而序号已前进，增量同步会漏掉这些变化
+            if history_store is not None:
+                history_store.dirty = True
+            previous = _rates_snapshot
+            snapshot = refresh_rates_snapshot()
+            if previous is None or snapshot['version'] != previous['version']:
+                broadcaster.publish('reload', {'version': snapshot['version']})
+        except Exception:
+            logger.exception("检查数据变化失败")
+
+# 工作进程启动：参与调度租约选举，并同步其他进程的写入
+def start_worker_services():
+    global elector
+    if elector is not None:
+        return
+    elector = LeaseElector('scheduler', SCHEDULER_LEASE_TTL,
+                           on_elected=on_scheduler_elected, on_demoted=stop_scheduler)
+    elector.start()
+    if METRICS_DIR:
+        metrics.share(METRICS_DIR)
+    threading.Thread(target=watch_external_writes, name='sync', daemon=True).start()
+    threading.Thread(target=static_assets.build, name='static-assets', daemon=True).start()
+    atexit.register(elector.stop)
+
+if __name__ == '__main__':
+    init_db()  # 初始化数据库
+    
+    # 启动任务和定时任务在后台执行，服务器立即开始提供已有的数据
+    start_bootstrap()
+    threading.Thread(target=static_assets.build, name='static-assets', daemon=True).start()
     
-    # 启动服务器
+    # 启动开发服务器（生产环境使用多进程模式，见wsgi.py）
     app.run(host='0.0.0.0', port=9088)
\ No newline at end of file
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# 静态资源：首次使用时为每个文件计算内容指纹并生成gzip/brotli压缩版本，按Accept-Encoding直接返回预压缩的内容
+# 带指纹的URL（如 js/echarts.min.3f2a9c1b7e4d.js）的内容永远不变，浏览器可以长期缓存而不必重新验证；
+# 页面（index.html）中对这些文件的引用改写为带指纹的URL，页面本身每次用ETag验证
+#
+# 压缩结果按内容摘要保存在cache_dir中（可选），重启后不必重新压缩
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_LENGTH = 12
+
+
+class Asset:
+    def __init__(self, content, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(content).hexdigest()
+        self.variants = {None: content}
+
+    # 按客户端接受的压缩方式返回 (响应体, 实际使用的压缩方式)，没有该压缩版本时返回原始内容
+    def body(self, encoding):
+        if encoding in self.variants:
+            return self.variants[encoding], encoding
+        return self.variants[None], None
+
+    def etag(self, encoding):
+        return f'{self.digest[:32]}-{encoding}' if encoding else self.digest[:32]
+
+
+class StaticAssets:
+    def __init__(self, root, directories=('js',), pages=('index.html',), cache_dir=None, min_size=1024):
+        self.root = root
+        self.directories = directories
+        self.pages = pages
+        self.cache_dir = cache_dir
+        self.min_size = min_size
+        self.assets = None
+        self.immutable = set()
+        self.lock = threading.Lock()
+
+    # 带指纹的文件名：echarts.min.js -> echarts.min.<摘要前12位>.js
+    @staticmethod
+    def fingerprint(path, digest):
+        base, ext = os.path.splitext(path)
+        return f'{base}.{digest[:FINGERPRINT_LENGTH]}{ext}'
+
+    # 返回URL路径（相对于站点根目录）对应的资源，不存在时返回None
+    def get(self, path):
+        if self.assets is None:
+            self.build()
+        return self.assets.get(path)
+
+    # 带指纹的URL内容永远不变
+    def is_immutable(self, path):
+        return path in self.immutable
+
+    def build(self):
+        with self.lock:
+            if self.assets is not None:
+                return
+            assets = {}
+            immutable = set()
+            references = {}
+            for directory in self.directories:
+                for name in sorted(os.listdir(os.path.join(self.root, directory))):
+                    path = f'{directory}/{name}'
+                    content = self.read(path)
+                    if content is None:
+                        continue
+                    asset = self.create(path, content)
+                    url = self.fingerprint(path, asset.digest)
+                    # 不带指纹的URL仍然可用（兼容旧页面），但需要每次验证
+                    assets[url] = assets[path] = asset
+                    immutable.add(url)
+                    references[path] = url
+            for page in self.pages:
+                content = self.read(page)
+                if content is None:
+                    continue
+                text = content.decode('utf-8')
+                for path, url in references.items():
+                    text = text.replace(f'"{path}"', f'"{url}"')
+                assets[page] = self.create(page, text.encode('utf-8'))
+            self.immutable = immutable
+            self.assets = assets
+            logger.info("静态资源已就绪 files=%d", len(references) + len(self.pages))
+
+    def read(self, path):
+        try:
+            with open(os.path.join(self.root, path), 'rb') as f:
+                return f.read()
+        except OSError:
+            logger.warning("读取静态资源失败 path=%s", path)
+            return None
+
+    def create(self, path, content):
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        asset = Asset(content, mimetype)
+        if len(content) < self.min_size:
+            return asset
+        asset.variants['gzip'] = self.compressed(asset.digest, 'gz', lambda: gzip.compress(content, 9, mtime=0))
+        if brotli is not None:
+            asset.variants['br'] = self.compressed(asset.digest, 'br',
+                                                   lambda: brotli.compress(content, mode=brotli.MODE_TEXT))
+        return asset
+
+    # 读取保存的压缩结果，没有时压缩并保存
+    def compressed(self, digest, suffix, compress):
+        if not self.cache_dir:
+            return compress()
+        path = os.path.join(self.cache_dir, f'{digest}.{suffix}')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+        body = compress()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning("保存压缩的静态资源失败 path=%s", path)
+        return body
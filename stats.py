@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# 滚动统计引擎：基于最终数据预先计算日涨跌幅、移动平均、波动率和区间最高/最低，
+# 追加新的一天时只计算新增的一行（O(窗口)），历史数据被改写时再整体重算
+import bisect
+import threading
+
+import numpy as np
+
+import db
+
+DEFAULT_WINDOWS = (7, 30, 90)
+
+
+# 可增长的一维数组，追加时按倍数扩容，避免每次追加都复制整个数组
+class GrowableArray:
+    def __init__(self, dtype=np.float64, capacity=256):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            grown = np.empty(max(needed, len(self.data) * 2), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def append(self, value):
+        self.extend([value])
+
+    def view(self):
+        return self.data[:self.size]
+
+
+# 计算窗口内的滚动统计（向量化），前 window-1 个位置为NaN
+def _rolling(values, window, func):
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        windows = np.lib.stride_tricks.sliding_window_view(values, window)
+        result[window - 1:] = func(windows, axis=1)
+    return result
+
+
+# 单个货币的统计序列
+class CurrencyStats:
+    def __init__(self, windows):
+        self.windows = windows
+        self.rate = GrowableArray()
+        self.change_pct = GrowableArray()
+        self.series = {}
+        for window in windows:
+            for name in ('sma', 'volatility', 'min', 'max'):
+                self.series[f'{name}_{window}'] = GrowableArray()
+
+    # 整体重算（向量化）
+    def rebuild(self, values):
+        self.__init__(self.windows)
+        values = np.asarray(values, dtype=np.float64)
+        change = np.full(len(values), np.nan)
+        if len(values) > 1:
+            change[1:] = (values[1:] / values[:-1] - 1) * 100
+        self.rate.extend(values)
+        self.change_pct.extend(change)
+        for window in self.windows:
+            self.series[f'sma_{window}'].extend(_rolling(values, window, np.mean))
+            self.series[f'volatility_{window}'].extend(_rolling(change, window, np.std))
+            self.series[f'min_{window}'].extend(_rolling(values, window, np.min))
+            self.series[f'max_{window}'].extend(_rolling(values, window, np.max))
+
+    # 追加一天，只计算新的一行
+    def append(self, value):
+        self.rate.append(value)
+        values = self.rate.view()
+        change = (values[-1] / values[-2] - 1) * 100 if len(values) > 1 else np.nan
+        self.change_pct.append(change)
+        changes = self.change_pct.view()
+        for window in self.windows:
+            full = len(values) >= window
+            tail = values[-window:]
+            self.series[f'sma_{window}'].append(tail.mean() if full else np.nan)
+            self.series[f'volatility_{window}'].append(changes[-window:].std() if full else np.nan)
+            self.series[f'min_{window}'].append(tail.min() if full else np.nan)
+            self.series[f'max_{window}'].append(tail.max() if full else np.nan)
+
+    # 删除最后一天（同一天的最终数据被改写时先删除再追加）
+    def pop(self):
+        for array in [self.rate, self.change_pct] + list(self.series.values()):
+            array.size -= 1
+
+    def columns(self):
+        columns = {'rate': self.rate.view(), 'change_pct': self.change_pct.view()}
+        for name, array in self.series.items():
+            columns[name] = array.view()
+        return columns
+
+
+# 所有货币的滚动统计，version在数据变化时递增，用于缓存失效
+class RollingStats:
+    def __init__(self, windows=DEFAULT_WINDOWS):
+        self.windows = tuple(windows)
+        self.lock = threading.Lock()
+        self.dates = []
+        self.currencies = []
+        self.stats = {}
+        self.version = 0
+        self.dirty = True
+        self.rebuilding = 0  # 正在进行的重算数
+
+    # 从数据库读取全部最终数据并整体重算；缺失值沿用前一天的汇率
+    # 读取前清除标记，读取期间写入的数据可能不在结果中，由写入监听器重新标记
+    def rebuild(self):
+        with self.lock:
+            self.dirty = False
+            self.rebuilding += 1
+        try:
+            rows = db.load_rates_range(final_only=True)
+            currencies = list(db.CURRENCIES)
+            dates = [row[0] for row in rows]
+            stats = {}
+            for i, currency in enumerate(currencies):
+                values = forward_fill(np.array([np.nan if row[i + 1] is None else row[i + 1] for row in rows],
+                                                dtype=np.float64))
+                stats[currency] = CurrencyStats(self.windows)
+                stats[currency].rebuild(values)
+        except Exception:
+            with self.lock:
+                self.dirty = True
+                self.rebuilding -= 1
+            raise
+        with self.lock:
+            self.dates, self.currencies, self.stats = dates, currencies, stats
+            self.version += 1
+            self.rebuilding -= 1
+
+    # 数据有变化或货币列表变化时重算
+    def refresh_if_needed(self):
+        if self.dirty or self.currencies != list(db.CURRENCIES):
+            self.rebuild()
+
+    # 汇率写入后调用（可注册为db的写入监听器）
+    def on_write(self, rows, is_final):
+        # 正在重算时不做增量更新（会作用在即将被替换的结果上），重算完成后再重算一次
+        if self.rebuilding:
+            self.dirty = True
+            return
+        dates = [date for date, _ in rows]
+        if is_final:
+            self.on_final_dates(dates)
+        elif self.dates and min(dates) <= self.dates[-1]:
+            # 最终数据被改写为非最终数据
+            self.dirty = True
+
+    # 最终数据写入后调用：最后一天之后的新日期增量追加，改写最后一天时替换，改写更早的日期则标记为需要重算
+    def on_final_dates(self, dates):
+        if self.dirty:
+            return
+        for date in sorted(dates):
+            if self.dates and date < self.dates[-1]:
+                self.dirty = True
+                return
+            row = db.load_rates_range(date, date, self.currencies, final_only=True)
+            if not row:
+                continue
+            with self.lock:
+                replace = bool(self.dates) and self.dates[-1] == date
+                if replace:
+                    self.dates.pop()
+                for i, currency in enumerate(self.currencies):
+                    stats = self.stats[currency]
+                    if replace:
+                        stats.pop()
+                    value = row[0][i + 1]
+                    if value is None:
+                        previous = stats.rate.view()
+                        value = previous[-1] if len(previous) else np.nan
+                    stats.append(value)
+                self.dates.append(date)
+                self.version += 1
+
+    # 返回 [start, end] 范围内指定货币的统计结果（可直接JSON序列化）
+    def query(self, start=None, end=None, currencies=None):
+        self.refresh_if_needed()
+        with self.lock:
+            lo = bisect.bisect_left(self.dates, start) if start else 0
+            hi = bisect.bisect_right(self.dates, end) if end else len(self.dates)
+            result = {'windows': list(self.windows), 'dates': self.dates[lo:hi]}
+            for currency in currencies or self.currencies:
+                columns = self.stats[currency].columns()
+                series = {name: _to_list(values[lo:hi]) for name, values in columns.items()}
+                rates = columns['rate'][lo:hi]
+                valid = rates[~np.isnan(rates)]
+                series['summary'] = {
+                    'latest': float(valid[-1]) if len(valid) else None,
+                    'min': float(valid.min()) if len(valid) else None,
+                    'max': float(valid.max()) if len(valid) else None,
+                    'change_pct': float((valid[-1] / valid[0] - 1) * 100) if len(valid) > 1 else None
+                }
+                result[currency] = series
+            return result
+
+
+# 用前一个有效值填充NaN（开头的NaN保留）
+def forward_fill(values):
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(index, out=index)
+    return values[index]
+
+
+def _to_list(values):
+    return [None if np.isnan(v) else round(float(v), 8) for v in values]
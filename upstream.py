@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# 上游汇率API客户端：连接复用、按源统计延迟、熔断和对冲请求
+#
+# 对冲请求：先请求首选源，若在其p95延迟内没有返回，再并行请求下一个可用源，取最先成功的结果
+# 可选的磁盘缓存（upstream_cache.UpstreamCache）：命中时不访问网络
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'application/json'
+}
+
+
+# 熔断器：连续失败达到阈值后打开，冷却期内不再请求该源；冷却期后放行一次试探请求（半开）
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    # 是否允许发起请求
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+# 单个上游源：URL模板、延迟样本和熔断器
+class UpstreamSource:
+    def __init__(self, template, breaker=None, samples=200):
+        self.template = template
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=samples)
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.template.split('/')[2]
+
+    def url(self, date, currency):
+        return self.template.format(date=date, currency=currency)
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    # 延迟分位数，样本不足时返回None
+    def percentile(self, q, min_samples=10):
+        with self.lock:
+            samples = sorted(self.latencies)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+class UpstreamClient:
+    def __init__(self, templates, timeout=10, hedge_default=1.0, hedge_min=0.05, pool_size=16, cache=None):
+        self.sources = [UpstreamSource(template) for template in templates]
+        self.cache = cache
+        self.timeout = timeout
+        self.hedge_default = hedge_default
+        self.hedge_min = hedge_min
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.sources), pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(HEADERS)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='upstream')
+
+    # 对冲等待时间：首选源的p95延迟，样本不足时使用默认值
+    def hedge_delay(self, source):
+        p95 = source.percentile(0.95)
+        if p95 is None:
+            return self.hedge_default
+        return min(max(p95, self.hedge_min), self.timeout)
+
+    # 请求单个源，返回 (源, JSON数据或None)；网络错误和5xx计入熔断，404等视为该源没有数据
+    def _request(self, source, date, currency):
+        url = source.url(date, currency)
+        started = time.monotonic()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except Exception as e:
+            elapsed = time.monotonic() - started
+            source.breaker.record_failure()
+            metrics.UPSTREAM_LATENCY.observe(elapsed, source=source.name, outcome='error')
+            logger.warning("API请求失败 source=%s date=%s error=%s", source.name, date, e)
+            return source, None
+        elapsed = time.monotonic() - started
+        source.record_latency(elapsed)
+        if response.status_code >= 500:
+            source.breaker.record_failure()
+            metrics.UPSTREAM_LATENCY.observe(elapsed, source=source.name, outcome='5xx')
+            logger.warning("API请求失败 source=%s date=%s status=%d", source.name, date, response.status_code)
+            return source, None
+        source.breaker.record_success()
+        if response.status_code != 200:
+            metrics.UPSTREAM_LATENCY.observe(elapsed, source=source.name, outcome='missing')
+            return source, None
+        try:
+            data = response.json()
+        except ValueError:
+            metrics.UPSTREAM_LATENCY.observe(elapsed, source=source.name, outcome='invalid')
+            logger.warning("API响应不是有效的JSON source=%s date=%s", source.name, date)
+            return source, None
+        metrics.UPSTREAM_LATENCY.observe(elapsed, source=source.name, outcome='ok')
+        if self.cache is not None:
+            try:
+                self.cache.put(source.name, date, currency, response.content)
+            except Exception:
+                logger.exception("写入上游缓存失败 source=%s date=%s", source.name, date)
+        return source, data
+
+    # 按源的优先级查找磁盘缓存，返回JSON数据或None
+    def _cached(self, date, currency):
+        for source in self.sources:
+            try:
+                content = self.cache.get(source.name, date, currency)
+            except Exception:
+                logger.exception("读取上游缓存失败 source=%s date=%s", source.name, date)
+                continue
+            if content is None:
+                continue
+            try:
+                data = json.loads(content)
+            except ValueError:
+                continue
+            metrics.CACHE_REQUESTS.inc(cache='upstream_disk', result='hit')
+            return data
+        metrics.CACHE_REQUESTS.inc(cache='upstream_disk', result='miss')
+        return None
+
+    # 获取某日某货币的文档，返回JSON数据，所有源都失败时返回None
+    def fetch_json(self, date, currency):
+        return self.fetch(date, currency)[0]
+
+    # 同fetch_json，返回 (JSON数据, 是否来自磁盘缓存)
+    def fetch(self, date, currency):
+        if self.cache is not None:
+            data = self._cached(date, currency)
+            if data is not None:
+                return data, True
+        sources = iter(self.sources)
+
+        # 按顺序取下一个熔断器放行的源（放行时才占用半开状态的试探名额）
+        def next_source():
+            for source in sources:
+                if source.breaker.allow():
+                    return source
+            return None
+
+        source = next_source()
+        if source is None:
+            logger.warning("所有API源都处于熔断状态 date=%s", date)
+            return None, False
+        pending = {self.executor.submit(self._request, source, date, currency)}
+        delay = self.hedge_delay(source)
+        exhausted = False
+        while pending:
+            done, pending = wait(pending, timeout=None if exhausted else delay, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, data = future.result()
+                if data is not None:
+                    return data, False
+            # 首选源在p95内没有返回（对冲），或已完成的请求都失败了，请求下一个源
+            if not done or not pending:
+                hedge = next_source() if not exhausted else None
+                if hedge is None:
+                    exhausted = True
+                    continue
+                if not done:
+                    logger.info("响应较慢，发起对冲请求 source=%s hedge=%s date=%s", source.name, hedge.name, date)
+                source = hedge
+                pending.add(self.executor.submit(self._request, source, date, currency))
+                delay = self.hedge_delay(source)
+        return None, False
+
+    # 各源的状态，用于监控
+    def status(self):
+        return [{
+            'source': source.name,
+            'state': source.breaker.state,
+            'p50': source.percentile(0.5),
+            'p95': source.percentile(0.95)
+        } for source in self.sources]
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# 上游响应的磁盘缓存：按 (源, 日期, 货币) 索引，内容按SHA-256寻址并压缩存储，总大小超过上限时按最近访问时间淘汰
+# 过去日期的文档不会再变化，可以一直使用；今天及以后的日期只在ttl秒内有效
+#
+# 目录结构：
+#   index.db            索引（SQLite）：key -> digest, size, stored_at, accessed_at
+#   objects/ab/abcd...  压缩后的响应内容，相同内容只保存一份
+import datetime
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamCache:
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, today_ttl=600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.today_ttl = today_ttl
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.db'), timeout=30,
+                                    check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS entries
+                             (key TEXT PRIMARY KEY,
+                              date TEXT NOT NULL,
+                              digest TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              stored_at REAL NOT NULL,
+                              accessed_at REAL NOT NULL)''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed_at)")
+
+    @staticmethod
+    def key(source, date, currency):
+        return f'{source}|{date}|{currency}'
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    # 日期是否可能还会变化（今天及以后，或latest）
+    def is_mutable(self, date):
+        return date == 'latest' or date >= datetime.date.today().isoformat()
+
+    # 读取缓存的响应内容，未命中或已过期时返回None
+    def get(self, source, date, currency):
+        key = self.key(source, date, currency)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT digest, stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            digest, stored_at = row
+            if self.is_mutable(date) and now - stored_at > self.today_ttl:
+                return None
+            try:
+                with open(self.object_path(digest), 'rb') as f:
+                    content = zlib.decompress(f.read())
+            except (OSError, zlib.error):
+                # 对象文件丢失或损坏，删除索引
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return content
+
+    # 保存响应内容（原始字节）
+    def put(self, source, date, currency, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.object_path(digest)
+        now = time.time()
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 先写临时文件再重命名，避免并发读取到写了一半的文件
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(zlib.compress(content, 6))
+                os.replace(tmp, path)
+            size = os.path.getsize(path)
+            key = self.key(source, date, currency)
+            previous = self.conn.execute("SELECT digest FROM entries WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO entries (key, date, digest, size, stored_at, accessed_at) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (key, date, digest, size, now, now))
+            # 今天的文档内容更新后，旧内容不再被引用
+            if previous and previous[0] != digest:
+                self.release(previous[0])
+            self.evict()
+
+    # 没有条目引用该对象时删除文件，返回释放的字节数
+    def release(self, digest):
+        if self.conn.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+            return 0
+        path = self.object_path(digest)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
+
+    # 总大小（按对象去重）超过上限时，按最近访问时间淘汰到上限的90%
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                                  "(SELECT size FROM entries GROUP BY digest)").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for key, digest in self.conn.execute("SELECT key, digest FROM entries ORDER BY accessed_at").fetchall():
+            if total <= target:
+                break
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            evicted += 1
+            total -= self.release(digest)
+        logger.info("上游缓存已淘汰 entries=%d size=%d", evicted, total)
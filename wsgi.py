@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+# 生产环境入口（多进程）：
+#   gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:9088 wsgi:app
+# 每个SSE连接（/api/stream）在连接期间占用一个线程，最多只能同时处理 工作进程数×线程数 个连接，
+# 线程被SSE占满后其他请求都会排队；SSE客户端较多时用另一组进程单独提供 /api/stream（见README）。
+# 不要使用gevent等协程工作进程：数据库连接按线程保存，SQLite查询会阻塞整个进程
+# 每个工作进程都提供读服务；通过数据库中的调度租约选出一个进程运行回填和定时任务，
+# 该进程退出后其他进程在租约过期（SCHEDULER_LEASE_TTL秒）后接管。
+# 不要使用 --preload：数据库连接和后台线程必须在各个工作进程中创建
+from server import app, init_db, start_worker_services
+
+init_db()
+start_worker_services()